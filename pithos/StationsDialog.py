@@ -229,9 +229,6 @@ class StationsDialog(Gtk.Dialog):
                 self.pithos.station_already_exists(existing_station[0], description, music_type, self)
                 return
         logging.debug("1 " + repr(station))
-        # We shouldn't actually add the station to the pandora stations list
-        # until we know it's not a duplicate.
-        self.pithos.pandora.stations.append(station)
         it = self.model.insert_with_valuesv(0, (0, 1, 2), (station, station.name, 0))
         logging.debug("2 " + repr(it))
         self.emit('station-added', station)
@@ -129,8 +129,11 @@ class StationsPopover(Gtk.Popover):
     def change_row(self, model, path, iter, data=None):
         station, name, index = model.get(iter, 0, 1, 2)
         for row in self.listbox.get_children():
-            if row.station == station:
-                row.name, row.index = name, index
+            # The station object is replaced when a cached list becomes the real one.
+            if row.station.id == station.id:
+                row.station, row.index = station, index
+                # Picks up renames found when the list is refreshed.
+                row.label.set_text(name)
                 self.listbox.invalidate_sort()
                 break
         else:
@@ -146,13 +149,13 @@ class StationsPopover(Gtk.Popover):
 
     def select_station(self, station):
         for row in self.listbox.get_children():
-            if row.station == station:
+            if row.station.id == station.id:
                 self.listbox.select_row(row)
                 break
 
     def remove_station(self, station):
         for row in self.listbox.get_children():
-            if row.station == station:
+            if row.station.id == station.id:
                 self.listbox.remove(row)
                 break
 
@@ -0,0 +1,252 @@
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: nil; -*-
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Album art caches
+
+:py:class:`ArtCache` stores covers under a hash of their url so songs from
+the same album share one file and its ``file://`` url stays the same across
+sessions, which lets notifications and MPRIS clients reuse it. A file's
+mtime is its last use and the least recently used covers are removed once
+the cache grows past its size limit.
+
+:py:class:`PixbufCache` keeps the decoded covers in memory so songs from
+the same album share one pixbuf.
+"""
+
+import collections
+import contextlib
+import hashlib
+import logging
+import os
+import threading
+import urllib.parse
+import urllib.request
+
+from gi.repository import GdkPixbuf
+
+from .pandora.pandora import HTTP_TIMEOUT
+from .util import atomic_write
+
+# A cover is around 50 KiB
+MAX_BYTES = 64 * 1024 * 1024
+# A decoded 96px cover is 27 KiB
+PIXBUF_MAX_BYTES = 16 * 1024 * 1024
+CHUNK_SIZE = 16 * 1024
+_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp')
+
+
+def file_url(path):
+    return urllib.parse.urljoin('file://', urllib.parse.quote(path))
+
+
+class ArtCache:
+    """Album art on disk keyed by url
+
+    :param directory: Where the covers are kept, created when first needed
+    :param max_bytes: Size the cache is trimmed back to
+    """
+    def __init__(self, directory, max_bytes=MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # path: size, filled on first use
+        self._sizes = None
+        self._total = 0
+
+    def path_for(self, url):
+        digest = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        extension = os.path.splitext(urllib.parse.urlparse(url).path)[1].lower()
+        if extension not in _EXTENSIONS:
+            extension = ''
+        return os.path.join(self.directory, digest + extension)
+
+    def _scan(self):
+        # Called with the lock held
+        if self._sizes is not None:
+            return
+        self._sizes = {}
+        self._total = 0
+        try:
+            entries = list(os.scandir(self.directory))
+        except FileNotFoundError:
+            return
+        except OSError as e:
+            logging.warning('Failed to read album art cache: {}'.format(e))
+            return
+        for entry in entries:
+            if entry.name.startswith('.') or not entry.is_file():
+                continue
+            size = entry.stat().st_size
+            self._sizes[entry.path] = size
+            self._total += size
+
+    def lookup(self, url):
+        """Returns the path of the cached cover or None, this blocks"""
+        path = self.path_for(url)
+        try:
+            # Marks it as recently used
+            os.utime(path)
+        except OSError:
+            return None
+        return path
+
+    def get(self, url):
+        """Returns the cached cover as (path, bytes) or None, this blocks"""
+        path = self.path_for(url)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            # Marks it as recently used
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            logging.warning('Failed to read cached album art: {}'.format(e))
+            return None
+        return path, data
+
+    def put(self, url, data):
+        """Stores data as the cover of url
+
+        :returns: The path of the file or None if it couldn't be written
+        """
+        path = self.path_for(url)
+        with self._lock:
+            self._scan()
+            try:
+                with atomic_write(path, prefix='.art-') as f:
+                    f.write(data)
+            except OSError as e:
+                logging.warning('Failed to store album art: {}'.format(e))
+                return None
+            self._total += len(data) - self._sizes.get(path, 0)
+            self._sizes[path] = len(data)
+            if self._total > self.max_bytes:
+                self._evict(keep=path)
+        return path
+
+    def _evict(self, keep):
+        # Called with the lock held, trims to 90% so this doesn't run on every put
+        target = self.max_bytes * 9 // 10
+        by_age = []
+        for path in self._sizes:
+            try:
+                by_age.append((os.stat(path).st_mtime, path))
+            except OSError:
+                by_age.append((0, path))
+        by_age.sort()
+        for mtime, path in by_age:
+            if self._total <= target:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logging.warning('Failed to remove cached album art: {}'.format(e))
+                continue
+            self._total -= self._sizes.pop(path)
+
+    def fetch(self, url, cancel_token=None):
+        """Returns (path, bytes) for url from the cache or the network, this blocks
+
+        :param cancel_token: Checked between chunks of the download
+        :returns: path is None if the cover couldn't be cached
+        :raises OSError: If the download failed or timed out
+        """
+        cached = self.get(url)
+        if cached is not None:
+            return cached
+        chunks = []
+        # A stalled server must not hold a worker thread for good.
+        with urllib.request.urlopen(url, timeout=HTTP_TIMEOUT) as f:
+            # Read in chunks so a cancelled download stops early.
+            while True:
+                if cancel_token is not None:
+                    cancel_token.check()
+                chunk = f.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        data = b''.join(chunks)
+        return self.put(url, data), data
+
+
+def _pixbuf_bytes(pixbuf):
+    return pixbuf.get_rowstride() * pixbuf.get_height()
+
+
+class PixbufCache:
+    """Decoded covers keyed by url and size, safe to use from worker threads
+
+    A size that isn't cached is scaled down from a larger one of the same
+    cover rather than decoded again.
+
+    :param max_bytes: Pixel memory the least recently used pixbufs are dropped past
+    """
+    def __init__(self, max_bytes=PIXBUF_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._pixbufs = collections.OrderedDict()
+        # url: sizes cached for it
+        self._sizes = collections.defaultdict(set)
+        self._total = 0
+
+    def _put(self, url, size, pixbuf):
+        # Called with the lock held
+        key = url, size
+        old = self._pixbufs.pop(key, None)
+        if old is not None:
+            self._total -= _pixbuf_bytes(old)
+        self._pixbufs[key] = pixbuf
+        self._sizes[url].add(size)
+        self._total += _pixbuf_bytes(pixbuf)
+        while self._total > self.max_bytes and len(self._pixbufs) > 1:
+            (old_url, old_size), old = self._pixbufs.popitem(last=False)
+            self._total -= _pixbuf_bytes(old)
+            self._sizes[old_url].discard(old_size)
+            if not self._sizes[old_url]:
+                del self._sizes[old_url]
+
+    def get(self, url, size):
+        """Returns the cover of url fitting in size x size pixels or None if it has to be decoded"""
+        with self._lock:
+            key = url, size
+            pixbuf = self._pixbufs.get(key)
+            if pixbuf is not None:
+                self._pixbufs.move_to_end(key)
+                return pixbuf
+            larger = [s for s in self._sizes.get(url, ()) if s > size]
+            if not larger:
+                return None
+            source = self._pixbufs[(url, min(larger))]
+        # Scaling is the slow part, don't hold the lock for it.
+        scale = size / max(source.get_width(), source.get_height())
+        pixbuf = source.scale_simple(max(1, round(source.get_width() * scale)),
+                                     max(1, round(source.get_height() * scale)),
+                                     GdkPixbuf.InterpType.BILINEAR)
+        with self._lock:
+            self._put(url, size, pixbuf)
+        return pixbuf
+
+    def decode(self, url, size, data):
+        """Decodes data, the image at url, to fit in size x size pixels and caches it"""
+        with contextlib.closing(GdkPixbuf.PixbufLoader()) as loader:
+            loader.set_size(size, size)
+            loader.write(data)
+        pixbuf = loader.get_pixbuf()
+        with self._lock:
+            self._put(url, size, pixbuf)
+        return pixbuf
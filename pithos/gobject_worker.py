@@ -12,31 +12,275 @@
 # You should have received a copy of the GNU General Public License along
 # with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import collections
 import logging
+import heapq
+import itertools
 import threading
+import time
 from gi.repository import GLib
 import traceback
 
+# Lanes of the worker pool, lower runs first
+PRIORITY_INTERACTIVE = 0  # Something the user just did: login, skip, rate, search
+PRIORITY_PLAYBACK = 1     # Needed to keep the music going: playlists
+PRIORITY_BACKGROUND = 2   # Everything else: album art, titles, feedback, session refresh
+PRIORITY_NAMES = ('interactive', 'playback', 'background')
+
+MAX_THREADS = 8
+# Leaves the other threads free for the lanes above even when a lot of art is loading
+MAX_BACKGROUND_THREADS = 3
+# Seconds an idle thread waits for work before exiting
+IDLE_TIMEOUT = 30
+# Threads one kind of task may take at once, so a stalled server can only hold
+# up its own kind and not everything else in the lane
+KIND_LIMITS = {
+    'album-art': 2,
+    'song-title': 2,
+}
+
+
+class WorkerPool:
+    """A bounded pool of reusable threads that runs the highest priority task first
+
+    Background tasks never take more than max_background threads and tasks
+    of a kind in kind_limits never more than its limit. Tasks that have to
+    wait for either don't hold up the ones queued behind them.
+
+    :param max_threads:    The most threads running at once
+    :param max_background: The most threads running :py:data:`PRIORITY_BACKGROUND` tasks
+    :param idle_timeout:   Seconds an idle thread waits before exiting
+    :param kind_limits:    Kind of task: the most threads running it
+    """
+    def __init__(self, max_threads=MAX_THREADS, max_background=MAX_BACKGROUND_THREADS,
+                 idle_timeout=IDLE_TIMEOUT, kind_limits=KIND_LIMITS):
+        self.max_threads = max_threads
+        self.max_background = max_background
+        self.idle_timeout = idle_timeout
+        self.kind_limits = dict(kind_limits)
+        self._running_kinds = collections.Counter()
+        self._queue = []
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._threads = 0
+        self._idle = 0
+        self._running = [0] * len(PRIORITY_NAMES)
+        self._completed = [0] * len(PRIORITY_NAMES)
+        self._wait_total = [0.0] * len(PRIORITY_NAMES)
+        self._wait_max = [0.0] * len(PRIORITY_NAMES)
+
+    def submit(self, fn, priority=PRIORITY_INTERACTIVE, kind=None):
+        """Queues fn to be called without arguments on a pool thread
+
+        :param kind: What the task does, e.g. 'album-art', for :py:attr:`kind_limits`
+        """
+        if priority not in (PRIORITY_INTERACTIVE, PRIORITY_PLAYBACK, PRIORITY_BACKGROUND):
+            raise ValueError('Unknown priority {}'.format(priority))
+        with self._cond:
+            heapq.heappush(self._queue, (priority, next(self._counter), time.monotonic(), kind, fn))
+            self._cond.notify()
+            # Idle threads that were already woken count towards the queue too.
+            if len(self._queue) > self._idle and self._threads < self.max_threads:
+                self._threads += 1
+                thread = threading.Thread(target=self._run, name='pithos-worker')
+                thread.daemon = True
+                thread.start()
+
+    def _may_run(self, task):
+        # Called with the lock held
+        priority, _, _, kind, _ = task
+        if priority == PRIORITY_BACKGROUND and self._running[PRIORITY_BACKGROUND] >= self.max_background:
+            return False
+        limit = self.kind_limits.get(kind)
+        return limit is None or self._running_kinds[kind] < limit
+
+    def _next_task(self):
+        # Called with the lock held, returns None if nothing may run yet
+        if not self._queue:
+            return None
+        if self._may_run(self._queue[0]):
+            return heapq.heappop(self._queue)
+        # The first task has to wait, look for the best one that doesn't.
+        task = min((task for task in self._queue if self._may_run(task)), default=None)
+        if task is not None:
+            self._queue.remove(task)
+            heapq.heapify(self._queue)
+        return task
+
+    def _run(self):
+        while True:
+            with self._cond:
+                task = self._next_task()
+                while task is None:
+                    self._idle += 1
+                    woken = self._cond.wait(self.idle_timeout)
+                    self._idle -= 1
+                    task = self._next_task()
+                    if task is None and not woken:
+                        self._threads -= 1
+                        return
+                priority, _, queued, kind, fn = task
+                waited = time.monotonic() - queued
+                self._running[priority] += 1
+                self._running_kinds[kind] += 1
+                self._wait_total[priority] += waited
+                self._wait_max[priority] = max(self._wait_max[priority], waited)
+            try:
+                fn()
+            except Exception:
+                # Keep the thread serving, the counters below must stay right.
+                logging.exception('Unhandled exception in worker task')
+            finally:
+                with self._cond:
+                    self._running[priority] -= 1
+                    self._running_kinds[kind] -= 1
+                    self._completed[priority] += 1
+                    if self._queue:
+                        # A background or kind slot may have opened up.
+                        self._cond.notify()
+
+    def stats(self):
+        """Returns the queue depth, running tasks and wait times of each lane
+
+        :returns: A dict with threads, idle, kinds (running tasks of each kind
+                  that has some) and a dict per lane name with queued, running,
+                  completed, mean_wait and max_wait in seconds
+        """
+        with self._cond:
+            queued = [0] * len(PRIORITY_NAMES)
+            for task in self._queue:
+                queued[task[0]] += 1
+            kinds = {kind: n for kind, n in self._running_kinds.items() if kind is not None and n}
+            stats = {'threads': self._threads, 'idle': self._idle, 'kinds': kinds}
+            for priority, name in enumerate(PRIORITY_NAMES):
+                completed = self._completed[priority]
+                running = self._running[priority]
+                started = completed + running
+                stats[name] = {
+                    'queued': queued[priority],
+                    'running': running,
+                    'completed': completed,
+                    'mean_wait': self._wait_total[priority] / started if started else 0.0,
+                    'max_wait': self._wait_max[priority],
+                }
+            return stats
+
+
+class TaskCancelled(Exception):
+    """Raised by :py:meth:`CancelToken.check` once the task's token is cancelled"""
+
+
+class CancelToken:
+    """Marks a group of worker tasks as no longer wanted
+
+    Tasks that haven't started are skipped and results of the ones that
+    have are dropped, neither callback nor errorback is called. Long running
+    tasks can call :py:meth:`check` to stop early.
+    """
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def cancel(self):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def check(self):
+        """Raises :py:class:`TaskCancelled` if cancelled, call it from the task's thread"""
+        if self._event.is_set():
+            raise TaskCancelled()
+
+    def add_callback(self, callback):
+        """Calls callback from the thread that cancels, at once if that already happened"""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def remove_callback(self, callback):
+        with self._lock:
+            try:
+                self._callbacks.remove(callback)
+            except ValueError:
+                pass
+
+
+class CancelGroup:
+    """Hands out one :py:class:`CancelToken` per generation of work, e.g. per station
+
+    :py:meth:`cancel` cancels everything sent with the current token and starts a new generation.
+    """
+    def __init__(self):
+        self.token = CancelToken()
+
+    def cancel(self):
+        token, self.token = self.token, CancelToken()
+        token.cancel()
+
+
+_default_pool = None
+_default_pool_lock = threading.Lock()
+
+
+def default_pool():
+    """The pool shared by every :py:class:`GObjectWorker` not given one"""
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is None:
+            _default_pool = WorkerPool()
+        return _default_pool
+
 
 class GObjectWorker:
+    """Runs blocking calls on a :py:class:`WorkerPool` and delivers the results to the GLib main loop
 
-    def send(self, command, args=(), callback=None, errorback=None):
-        def run(data):
-            command, args, callback, errorback = data
+    :param pool: The pool to run on, by default the one shared by all workers
+    """
+    def __init__(self, pool=None):
+        self.pool = pool or default_pool()
+
+    def send(self, command, args=(), callback=None, errorback=None, priority=PRIORITY_INTERACTIVE,
+             cancel_token=None, kind=None):
+        """Calls command(*args) on the pool and then callback(result) or errorback(exception) on the main loop
+
+        :param cancel_token: A :py:class:`CancelToken`, once cancelled nothing more is called
+        :param kind:         What the task does, see :py:attr:`WorkerPool.kind_limits`
+        """
+        def deliver(fn, value):
+            # Tokens are cancelled on the main loop so this is the last word.
+            if cancel_token is None or not cancel_token.cancelled:
+                fn(value)
+
+        def run():
+            if cancel_token is not None and cancel_token.cancelled:
+                return
             try:
                 result = command(*args)
                 if callback:
-                    GLib.idle_add(callback, result)
+                    GLib.idle_add(deliver, callback, result)
+            except TaskCancelled:
+                pass
             except Exception as e:
                 e.traceback = traceback.format_exc()
                 if errorback:
-                    GLib.idle_add(errorback, e)
+                    GLib.idle_add(deliver, errorback, e)
         if errorback is None:
             errorback = self._default_errorback
-        data = command, args, callback, errorback
-        thread = threading.Thread(target=run, args=(data,))
-        thread.daemon = True
-        thread.start()
+        self.pool.submit(run, priority, kind)
+
+    def stats(self):
+        return self.pool.stats()
 
     def _default_errorback(self, error):
         logging.error("Unhandled exception in worker thread:\n{}".format(error.traceback))
@@ -59,5 +303,7 @@ if __name__ == '__main__':
     logging.info("sending")
     worker.send(test_cmd, (3, 4), test_cb)
     worker.send(test_cmd, ((), ()), test_cb) # trigger exception in worker to test error handling
+    worker.send(test_cmd, (5, 6), test_cb, priority=PRIORITY_BACKGROUND)
+    GLib.timeout_add_seconds(1, lambda: logging.info(worker.stats()) or True)
 
     Gtk.main()
@@ -41,7 +41,64 @@ adaptation of Bruce Schneier's `C implementation
 
 """
 
-import copy
+import binascii
+import hashlib
+import logging
+import os
+import struct
+import tempfile
+import threading
+from array import array
+
+from ..util import atomic_write
+
+_BLOCK = struct.Struct('>II')
+# P followed by the four S-boxes
+_TABLES = struct.Struct('>1042I')
+
+# array typecode holding at least 32 bits
+_WORD = 'I' if array('I').itemsize >= 4 else 'L'
+
+# Key schedules are expensive in pure Python and the same few keys are
+# used over and over, so they are kept for the lifetime of the process
+# and, if a directory has been set, on disk.
+_schedules = {}
+_schedules_lock = threading.Lock()
+_schedules_dir = None
+
+def set_key_schedule_dir(path):
+    """Sets the directory key schedules are stored in, None disables storing them"""
+    global _schedules_dir
+    _schedules_dir = path
+
+def _schedule_path(key):
+    return os.path.join(_schedules_dir, 'blowfish-{}'.format(hashlib.sha1(key).hexdigest()))
+
+def _load_schedule(key):
+    if not _schedules_dir:
+        return None
+    try:
+        with open(_schedule_path(key), 'rb') as f:
+            contents = f.read()
+    except OSError:
+        return None
+    payload, digest = contents[:_TABLES.size], contents[_TABLES.size:]
+    if len(payload) != _TABLES.size or hashlib.sha256(key + payload).digest() != digest:
+        logging.warning('Ignoring corrupt Blowfish key schedule cache')
+        return None
+    words = _TABLES.unpack(payload)
+    return array(_WORD, words[:18]), [list(words[i:i+256]) for i in range(18, 1042, 256)]
+
+def _save_schedule(key, tables):
+    if not _schedules_dir:
+        return
+    P, S = tables
+    payload = _TABLES.pack(*P, *S[0], *S[1], *S[2], *S[3])
+    try:
+        with atomic_write(_schedule_path(key), prefix='.blowfish-') as f:
+            f.write(payload + hashlib.sha256(key + payload).digest())
+    except OSError as e:
+        logging.warning('Failed to store Blowfish key schedule: {}'.format(e))
 
 class VCryptoException(Exception):
     """Exception for crypto operations."""
@@ -52,7 +109,8 @@ class Blowfish:
     """Blowfish cipher.
 
     When initialized the object can encrypt and decrypt blocks of
-    data with the :meth:`encrypt` and :meth:`decrypt` methods.
+    data with the :meth:`encrypt` and :meth:`decrypt` methods, or
+    whole buffers with :meth:`encrypt_ecb` and :meth:`decrypt_ecb`.
 
     :param key: cipher key
     :type  key: bytes
@@ -67,8 +125,30 @@ class Blowfish:
         elif len(key) > 56:
             raise VCryptoException('Max key length is 448 bits (56 bytes)')
 
-        P, S = copy.deepcopy(_P_INIT), copy.deepcopy(_S_INIT)
-        self.__P, self.__S = P, S
+        with _schedules_lock:
+            tables = _schedules.get(key)
+        if tables is None:
+            tables = _load_schedule(key)
+            if tables is None:
+                tables = self._key_schedule(key)
+                _save_schedule(key, tables)
+            with _schedules_lock:
+                _schedules[key] = tables
+
+        # The tables are never modified after the key schedule
+        # so every cipher using the same key can share them.
+        self._P, self._S = tables
+        # Round keys in decryption order
+        self._P_reversed = array(_WORD, reversed(self._P))
+        # The per-block reference implementation works on plain lists.
+        self.__P, self.__S = list(self._P), self._S
+
+    def _key_schedule(self, key):
+        # The S-boxes are indexed a lot so they stay flat lists, in CPython
+        # reading an array item has to create a new int object every time.
+        P = array(_WORD, _P_INIT)
+        S = [list(s) for s in _S_INIT]
+        self._P, self._S = P, S
 
         keylen = len(key)
         j = 0
@@ -81,22 +161,111 @@ class Blowfish:
                     j = 0
             P[i] ^= data
 
-        data = 8*b'\x00'
+        # Every step of the key schedule depends on the tables updated by
+        # the previous one, so this has to go one block at a time.
+        l = r = 0
         for i in range(0, len(P), 2):
-            data = self.encrypt(data)
-            P[i] = ((data[0] << 24) + (data[1] << 16) +
-                    (data[2] << 8 ) + data[3])
-            P[i+1] = ((data[4] << 24) + (data[5] << 16) +
-                      (data[6] << 8 ) + data[7])
+            l, r = self._crypt_words(l, r, P)
+            P[i] = l
+            P[i+1] = r
 
-        for i in range(4):
+        for box in S:
             for j in range(0, 256, 2):
-                data = self.encrypt(data)
-                S[i][j] = ((data[0] << 24) + (data[1] << 16) +
-                           (data[2] << 8 ) + data[3])
-                S[i][j+1] = ((data[4] << 24) +
-                             (data[5] << 16) +
-                             (data[6] << 8 ) + data[7])
+                l, r = self._crypt_words(l, r, P)
+                box[j] = l
+                box[j+1] = r
+
+        return P, S
+
+    def _crypt_words(self, l, r, P):
+        """Encrypts (or with reversed round keys decrypts) one block given as two words"""
+        S0, S1, S2, S3 = self._S
+        for i in range(0, 16, 2):
+            l ^= P[i]
+            r ^= (((S0[l >> 24] + S1[(l >> 16) & 0xff]) ^ S2[(l >> 8) & 0xff]) + S3[l & 0xff]) & 0xffffffff
+            r ^= P[i+1]
+            l ^= (((S0[r >> 24] + S1[(r >> 16) & 0xff]) ^ S2[(r >> 8) & 0xff]) + S3[r & 0xff]) & 0xffffffff
+        return r ^ P[17], l ^ P[16]
+
+    def _crypt_buffer(self, data, P):
+        if len(data) % 8:
+            raise VCryptoException('Data not aligned with 8-byte blocksize')
+        S0, S1, S2, S3 = self._S
+        p0, p1, p2, p3, p4, p5, p6, p7, p8, p9, p10, p11, p12, p13, p14, p15, p16, p17 = P
+        result = bytearray(len(data))
+        pack_into = _BLOCK.pack_into
+        offset = 0
+        for l, r in _BLOCK.iter_unpack(data):
+            # All 16 rounds unrolled, the swaps are folded into alternating l and r.
+            l ^= p0
+            r ^= (((S0[l >> 24] + S1[(l >> 16) & 0xff]) ^ S2[(l >> 8) & 0xff]) + S3[l & 0xff]) & 0xffffffff
+            r ^= p1
+            l ^= (((S0[r >> 24] + S1[(r >> 16) & 0xff]) ^ S2[(r >> 8) & 0xff]) + S3[r & 0xff]) & 0xffffffff
+            l ^= p2
+            r ^= (((S0[l >> 24] + S1[(l >> 16) & 0xff]) ^ S2[(l >> 8) & 0xff]) + S3[l & 0xff]) & 0xffffffff
+            r ^= p3
+            l ^= (((S0[r >> 24] + S1[(r >> 16) & 0xff]) ^ S2[(r >> 8) & 0xff]) + S3[r & 0xff]) & 0xffffffff
+            l ^= p4
+            r ^= (((S0[l >> 24] + S1[(l >> 16) & 0xff]) ^ S2[(l >> 8) & 0xff]) + S3[l & 0xff]) & 0xffffffff
+            r ^= p5
+            l ^= (((S0[r >> 24] + S1[(r >> 16) & 0xff]) ^ S2[(r >> 8) & 0xff]) + S3[r & 0xff]) & 0xffffffff
+            l ^= p6
+            r ^= (((S0[l >> 24] + S1[(l >> 16) & 0xff]) ^ S2[(l >> 8) & 0xff]) + S3[l & 0xff]) & 0xffffffff
+            r ^= p7
+            l ^= (((S0[r >> 24] + S1[(r >> 16) & 0xff]) ^ S2[(r >> 8) & 0xff]) + S3[r & 0xff]) & 0xffffffff
+            l ^= p8
+            r ^= (((S0[l >> 24] + S1[(l >> 16) & 0xff]) ^ S2[(l >> 8) & 0xff]) + S3[l & 0xff]) & 0xffffffff
+            r ^= p9
+            l ^= (((S0[r >> 24] + S1[(r >> 16) & 0xff]) ^ S2[(r >> 8) & 0xff]) + S3[r & 0xff]) & 0xffffffff
+            l ^= p10
+            r ^= (((S0[l >> 24] + S1[(l >> 16) & 0xff]) ^ S2[(l >> 8) & 0xff]) + S3[l & 0xff]) & 0xffffffff
+            r ^= p11
+            l ^= (((S0[r >> 24] + S1[(r >> 16) & 0xff]) ^ S2[(r >> 8) & 0xff]) + S3[r & 0xff]) & 0xffffffff
+            l ^= p12
+            r ^= (((S0[l >> 24] + S1[(l >> 16) & 0xff]) ^ S2[(l >> 8) & 0xff]) + S3[l & 0xff]) & 0xffffffff
+            r ^= p13
+            l ^= (((S0[r >> 24] + S1[(r >> 16) & 0xff]) ^ S2[(r >> 8) & 0xff]) + S3[r & 0xff]) & 0xffffffff
+            l ^= p14
+            r ^= (((S0[l >> 24] + S1[(l >> 16) & 0xff]) ^ S2[(l >> 8) & 0xff]) + S3[l & 0xff]) & 0xffffffff
+            r ^= p15
+            l ^= (((S0[r >> 24] + S1[(r >> 16) & 0xff]) ^ S2[(r >> 8) & 0xff]) + S3[r & 0xff]) & 0xffffffff
+            pack_into(result, offset, r ^ p17, l ^ p16)
+            offset += 8
+        return bytes(result)
+
+    def encrypt_ecb(self, data):
+        """Encipher a whole buffer block by block (ECB mode).
+
+        :param data:  plaintext, a multiple of 8 bytes long
+        :type  data:  bytes, bytearray or memoryview
+        :returns:     encrypted data
+        :rtype:       bytes
+        """
+        return self._crypt_buffer(data, self._P)
+
+    def decrypt_ecb(self, data):
+        """Decipher a whole buffer block by block (ECB mode).
+
+        :param data:  encrypted data, a multiple of 8 bytes long
+        :type  data:  bytes, bytearray or memoryview
+        :returns:     decrypted plaintext
+        :rtype:       bytes
+        """
+        return self._crypt_buffer(data, self._P_reversed)
+
+    def encrypt_hex(self, data):
+        """Zero pads data to the blocksize, enciphers it and returns it hex encoded"""
+        data = bytes(data)
+        if len(data) % 8:
+            data += b'\0' * (8 - len(data) % 8)
+        return binascii.hexlify(self.encrypt_ecb(data))
+
+    def decrypt_hex(self, data):
+        """Deciphers hex encoded data, zero padding it to the blocksize if needed"""
+        data = binascii.unhexlify(data)
+        if len(data) % 8:
+            data += b'\0' * (8 - len(data) % 8)
+        return self.decrypt_ecb(data)
 
     def __feistel(self, x):
         S = self.__S
@@ -131,22 +300,11 @@ class Blowfish:
             chaining techniques.
 
         """
-        len_data = len(data)
-        if len_data % 8:
-            raise VCryptoException('Data not aligned with 8-byte blocksize')
-        if len_data == 8:
-            return self._encrypt_block(data)
-        else:
-            result = []
-            start = 0
-            while start < len_data:
-                end = start + 8
-                block = data[start:end]
-                result.append(self._encrypt_block(block))
-                start += 8
-            return b''.join(result)
+        return self.encrypt_ecb(data)
 
     def _encrypt_block(self, block):
+        # Straightforward per-block reference implementation, used to
+        # check and benchmark the table driven one.
         if not isinstance(block, bytes) or len(block) != 8:
             raise VCryptoException('Data block must be bytes of len 8')
         b_l = ((block[0] << 24) + (block[1] << 16) +
@@ -179,20 +337,7 @@ class Blowfish:
         The block of encrypted data must be a multiple of 8 bytes.
 
         """
-        len_data = len(data)
-        if len_data % 8:
-            raise VCryptoException('Data not aligned with 8-byte blocksize')
-        if len_data == 8:
-            return self._decrypt_block(data)
-        else:
-            result = []
-            start = 0
-            while start < len_data:
-                end = start + 8
-                block = data[start:end]
-                result.append(self._decrypt_block(block))
-                start += 8
-            return b''.join(result)
+        return self.decrypt_ecb(data)
 
     def _decrypt_block(self, block):
         if not isinstance(block, bytes) or len(block) != 8:
@@ -396,4 +541,59 @@ _S_INIT = [[0xd1310ba6,0x98dfb5ac,0x2ffd72db,0xd01adfb7,0xb8e1afed,0x6a267e96,
             0x85cbfe4e,0x8ae88dd8,0x7aaaf9b0,0x4cf9aa7e,0x1948c25c,0x02fb8a8c,
             0x01c36ae4,0xd6ebe1f9,0x90d4f869,0xa65cdea0,0x3f09252d,0xc208e69f,
             0xb74e6132,0xce77e25b,0x578fdfe3,0x3ac372e6]
-           ]
\ No newline at end of file
+           ]
+
+if __name__ == '__main__':
+    # Microbenchmark: python3 -m pithos.pandora.blowfish
+    import codecs
+    import json
+    import timeit
+
+    cipher = Blowfish(b'6#26FRL$ZWD')
+    # About the size of a station.getPlaylist request body
+    payload = json.dumps({
+        'stationToken': '3914377363925265',
+        'includeTrackLength': True,
+        'additionalAudioUrl': 'HTTP_32_AACPLUS,HTTP_128_MP3',
+        'syncTime': 1500000000,
+        'userAuthToken': 'XXzn8JHcYDXTY4Jaf0vdeYWaVJSzB+EmKyAiQyxuOL4ABk0dDrUOgj5Ecf5VoUJBcuxZKbPw0MSz/U8dNvWNVtLQ==',
+    }).encode('utf-8')
+
+    def per_block():
+        # How Pandora.pandora_encrypt used to do it
+        return b''.join([codecs.encode(cipher._encrypt_block((payload[i:i+8] + b'\0' * 8)[:8]), 'hex_codec')
+                         for i in range(0, len(payload), 8)])
+
+    def batched():
+        return cipher.encrypt_hex(payload)
+
+    assert per_block() == batched()
+    runs = 2000
+    old = min(timeit.repeat(per_block, number=runs, repeat=3)) / runs
+    new = min(timeit.repeat(batched, number=runs, repeat=3)) / runs
+    print('{} byte payload: per-block {:.1f}us, batched {:.1f}us ({:.1f}x)'.format(
+          len(payload), old * 1e6, new * 1e6, old / new))
+
+    # Key schedules for the keys Pandora.connect uses, as computed, from disk and from memory
+    from pithos.pandora.data import client_keys
+    keys = [client[name].encode('utf-8') for client in client_keys.values() for name in ('encryptKey', 'decryptKey')]
+
+    def connect_ciphers():
+        for key in keys:
+            Blowfish(key)
+
+    def cold():
+        _schedules.clear()
+        connect_ciphers()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        set_key_schedule_dir(tmpdir)
+        cold()
+        assert Blowfish(keys[0]).encrypt_hex(payload) == Blowfish(b'6#26FRL$ZWD').encrypt_hex(payload)
+        runs = 20
+        computed = min(timeit.repeat(cold, setup=lambda: set_key_schedule_dir(None), number=runs, repeat=3)) / runs
+        set_key_schedule_dir(tmpdir)
+        from_disk = min(timeit.repeat(cold, number=runs, repeat=3)) / runs
+        from_memory = min(timeit.repeat(connect_ciphers, number=runs, repeat=3)) / runs
+    print('{} key schedules: computed {:.2f}ms, from disk {:.2f}ms, from memory {:.3f}ms'.format(
+          len(keys), computed * 1e3, from_disk * 1e3, from_memory * 1e3))
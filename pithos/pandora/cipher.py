@@ -0,0 +1,217 @@
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: nil; -*-
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Blowfish ECB backends
+
+:py:func:`new_cipher` returns a cipher from the first backend that can be
+imported and passes a known answer test, preferring C implementations and
+falling back to the pure Python :py:class:`pithos.pandora.blowfish.Blowfish`.
+Every cipher has the ``encrypt_ecb``, ``decrypt_ecb``, ``encrypt_hex`` and
+``decrypt_hex`` methods of the pure Python one.
+"""
+
+import binascii
+import logging
+import threading
+
+from .blowfish import Blowfish
+
+# Bruce Schneier's test vectors: (key, plaintext, ciphertext)
+_KNOWN_ANSWERS = (
+    (bytes(8), bytes(8), bytes.fromhex('4ef997456198dd78')),
+    (b'\xff' * 8, b'\xff' * 8, bytes.fromhex('51866fd5b85ecb8a')),
+    (bytes.fromhex('0123456789abcdef'), b'\x11' * 8, bytes.fromhex('61f9c3802281b096')),
+)
+
+
+class _Cipher:
+    """Adds the hex helpers of the pure Python Blowfish to a backend cipher"""
+
+    def encrypt_hex(self, data):
+        data = bytes(data)
+        if len(data) % 8:
+            data += b'\0' * (8 - len(data) % 8)
+        return binascii.hexlify(self.encrypt_ecb(data))
+
+    def decrypt_hex(self, data):
+        data = binascii.unhexlify(data)
+        if len(data) % 8:
+            data += b'\0' * (8 - len(data) % 8)
+        return self.decrypt_ecb(data)
+
+
+def _pycryptodome_backend(module):
+    def load():
+        Cipher = __import__(module, fromlist=['Blowfish']).Blowfish
+
+        class PyCryptodomeCipher(_Cipher):
+            def __init__(self, key):
+                # ECB cipher objects are stateless so one is enough for both directions.
+                self._cipher = Cipher.new(key, Cipher.MODE_ECB)
+
+            def encrypt_ecb(self, data):
+                return self._cipher.encrypt(bytes(data))
+
+            def decrypt_ecb(self, data):
+                return self._cipher.decrypt(bytes(data))
+
+        return PyCryptodomeCipher
+    return load
+
+
+def _cryptography_backend():
+    from cryptography.hazmat.primitives.ciphers import Cipher, modes
+    try:
+        from cryptography.hazmat.decrepit.ciphers.algorithms import Blowfish as Algorithm
+    except ImportError:
+        # cryptography < 43
+        from cryptography.hazmat.primitives.ciphers.algorithms import Blowfish as Algorithm
+
+    class CryptographyCipher(_Cipher):
+        def __init__(self, key):
+            self._cipher = Cipher(Algorithm(key), modes.ECB())
+
+        def encrypt_ecb(self, data):
+            encryptor = self._cipher.encryptor()
+            return encryptor.update(data) + encryptor.finalize()
+
+        def decrypt_ecb(self, data):
+            decryptor = self._cipher.decryptor()
+            return decryptor.update(data) + decryptor.finalize()
+
+    return CryptographyCipher
+
+
+def _python_backend():
+    return Blowfish
+
+
+# In order of preference, each loader returns a cipher class taking the key
+_backends = [
+    ('pycryptodomex', _pycryptodome_backend('Cryptodome.Cipher')),
+    ('pycryptodome', _pycryptodome_backend('Crypto.Cipher')),
+    ('cryptography', _cryptography_backend),
+    ('python', _python_backend),
+]
+_loaded = {}
+_lock = threading.Lock()
+
+
+def register_backend(name, loader, preferred=True):
+    """Adds a backend
+
+    :param loader:    Callable returning a cipher class taking the key, may raise ImportError
+    :param preferred: Whether to try it before the built in backends
+    """
+    with _lock:
+        _loaded.clear()
+        if preferred:
+            _backends.insert(0, (name, loader))
+        else:
+            _backends.insert(len(_backends) - 1, (name, loader))
+
+
+def _passes_known_answers(cipher_class):
+    for key, plaintext, ciphertext in _KNOWN_ANSWERS:
+        cipher = cipher_class(key)
+        if cipher.encrypt_ecb(plaintext * 3) != ciphertext * 3 or cipher.decrypt_ecb(ciphertext) != plaintext:
+            return False
+    return True
+
+
+def _load(name, loader):
+    if name not in _loaded:
+        try:
+            cipher_class = loader()
+            if not _passes_known_answers(cipher_class):
+                logging.warning('Blowfish backend {} failed its known answer test'.format(name))
+                cipher_class = None
+        except Exception as e:
+            logging.debug('Blowfish backend {} is not available: {}'.format(name, e))
+            cipher_class = None
+        _loaded[name] = cipher_class
+    return _loaded[name]
+
+
+def available_backends():
+    """Returns the names of the usable backends in order of preference"""
+    with _lock:
+        return [name for name, loader in _backends if _load(name, loader)]
+
+
+def new_cipher(key, backend=None):
+    """Returns a Blowfish ECB cipher for key
+
+    :param key:     The key as bytes
+    :param backend: Name of the backend to use, by default the first usable one
+    """
+    with _lock:
+        for name, loader in _backends:
+            if backend is not None and name != backend:
+                continue
+            cipher_class = _load(name, loader)
+            if cipher_class is not None:
+                return cipher_class(key)
+    raise ValueError('Blowfish backend {} is not available'.format(backend))
+
+
+if __name__ == '__main__':
+    # Conformance and throughput of every usable backend: python3 -m pithos.pandora.cipher
+    import json
+    import time
+    import timeit
+
+    from pithos.pandora.data import client_keys
+
+    def pandora_payloads():
+        # auth.userLogin and a station.getPlaylist body, as sent by Pandora.json_call
+        yield 'encryptKey', json.dumps({
+            'username': 'user@example.com', 'password': 'hunter2', 'loginType': 'user',
+            'returnIsSubscriber': True, 'syncTime': int(time.time()),
+            'partnerAuthToken': 'VAzrFVJvvJ2D9xUDdY8fDxH5HWjP1Csohl',
+        }).encode('utf-8')
+        yield 'encryptKey', json.dumps({
+            'stationToken': '3914377363925265', 'includeTrackLength': True,
+            'additionalAudioUrl': 'HTTP_32_AACPLUS,HTTP_128_MP3', 'syncTime': int(time.time()),
+            'userAuthToken': ('XXzn8JHcYDXTY4Jaf0vdeYWaVJSzB+EmKyAiQyxuOL4ABk0dDrUOgj5Ecf5'
+                              'VoUJBcuxZKbPw0MSz/U8dNvWNVtLQ=='),
+        }).encode('utf-8')
+        # The encrypted syncTime from auth.partnerLogin: 4 bytes of junk, the time and padding
+        yield 'decryptKey', b'\x9f\x84\xa9\xb3' + str(int(time.time())).encode('ascii') + b'\x02\x02'
+
+    backends = available_backends()
+    print('Usable backends:', ', '.join(backends))
+
+    failures = 0
+    for client_id, client in sorted(client_keys.items()):
+        for key_name, payload in pandora_payloads():
+            key = client[key_name].encode('utf-8')
+            reference = new_cipher(key, 'python')
+            expected = reference.encrypt_hex(payload)
+            for name in backends:
+                cipher = new_cipher(key, name)
+                ok = (cipher.encrypt_hex(payload) == expected and
+                      cipher.decrypt_hex(expected) == reference.decrypt_hex(expected))
+                failures += not ok
+                print('{:12} {:16} {:10} {} bytes: {}'.format(name, client_id, key_name, len(payload),
+                                                             'ok' if ok else 'MISMATCH'))
+
+    payload = b'x' * 4096
+    key = client_keys['android-generic']['encryptKey'].encode('utf-8')
+    for name in backends:
+        cipher = new_cipher(key, name)
+        runs = 50
+        elapsed = min(timeit.repeat(lambda: cipher.encrypt_ecb(payload), number=runs, repeat=3)) / runs
+        print('{:12} {:8.2f} MB/s'.format(name, len(payload) / elapsed / 1e6))
+
+    raise SystemExit(1 if failures else 0)
@@ -97,12 +97,19 @@ class FakePandora(Pandora):
 
     def connect(self, client, user, password):
         self.set_authenticated()
+        # Queued feedback is only sent while connected.
+        self.connected = True
         self.get_stations()
 
-    def get_station_by_token(self, token):
-        for i in self.stations:
-            if i.idToken == token:
-                return i
+    def partner_login(self, client):
+        self._reset_session(client)
+        time.sleep(1)
+        self.maybe_fail()
+        self.partnerId = 'fake-partner'
+        self.partnerAuthToken = 'fake-partner-token'
+
+    def user_login(self, user, password):
+        self.connect(None, user, password)
 
     def makeFakeSong(self, stationId):
         c = self.count()
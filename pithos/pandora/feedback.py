@@ -0,0 +1,287 @@
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: nil; -*-
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Outbound queue for song feedback
+
+Ratings, tired songs and bookmarks are applied to the :py:class:`Song`
+straight away and sent to Pandora later by :py:meth:`FeedbackQueue.flush`.
+Everything pending for a track is kept in one entry so opposing actions
+cancel out, loving and then unrating a song sends nothing. The queue is
+written to disk after every change so it survives restarts.
+"""
+
+import json
+import logging
+import threading
+import weakref
+
+from .pandora import (
+    PandoraAuthTokenInvalid, PandoraError, PandoraNetError,
+    RATE_BAN, RATE_LOVE, RATE_NONE,
+)
+from ..util import atomic_write
+
+# The steps of an entry in the order they're sent, with their API method
+_STEPS = (
+    ('rating', None),
+    ('tired', 'user.sleepSong'),
+    ('bookmark', 'bookmark.addSongBookmark'),
+    ('bookmarkArtist', 'bookmark.addArtistBookmark'),
+)
+
+
+class FeedbackQueue:
+    """Pending feedback keyed by trackToken
+
+    :param pandora: The :py:class:`Pandora` session used to send feedback
+    :param path:    JSON file the queue is kept in, None keeps it in memory only
+    """
+    def __init__(self, pandora, path=None):
+        self.pandora = pandora
+        self.path = path
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        # Tokens being sent, their entries are kept until the send finishes
+        self._sending = set()
+        self._songs = weakref.WeakValueDictionary()
+        self._entries = self._load()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def _load(self):
+        if not self.path:
+            return {}
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return {entry['trackToken']: entry for entry in json.load(f)}
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError, TypeError, KeyError) as e:
+            logging.warning('Ignoring unreadable feedback queue: {}'.format(e))
+            return {}
+
+    def _save(self):
+        # Called with the lock held
+        if not self.path:
+            return
+        try:
+            with atomic_write(self.path, 'w', prefix='.feedback-', encoding='utf-8') as f:
+                json.dump(list(self._entries.values()), f)
+        except OSError as e:
+            logging.warning('Failed to store feedback queue: {}'.format(e))
+
+    def _entry(self, song):
+        # Called with the lock held
+        self._songs[song.trackToken] = song
+        entry = self._entries.get(song.trackToken)
+        if entry is None:
+            entry = self._entries[song.trackToken] = {
+                'trackToken': song.trackToken,
+                'stationId': song.stationId,
+                'stationToken': None,
+                'songName': song.songName,
+                # What Pandora has and what we want it to have
+                'sentRating': song.rating,
+                'rating': song.rating,
+                'feedbackId': song.feedbackId,
+                'tired': False,
+                'bookmark': False,
+                'bookmarkArtist': False,
+            }
+        station = self.pandora.get_station_by_id(song.stationId)
+        if station is not None:
+            entry['stationToken'] = station.idToken
+        return entry
+
+    @staticmethod
+    def _is_pending(entry):
+        return (entry['rating'] != entry['sentRating'] or entry['tired']
+                or entry['bookmark'] or entry['bookmarkArtist'])
+
+    def _update(self, song, **changes):
+        with self._lock:
+            entry = self._entry(song)
+            entry.update(changes)
+            if not self._is_pending(entry) and song.trackToken not in self._sending:
+                del self._entries[song.trackToken]
+            self._save()
+
+    def rate(self, song, rating):
+        """Rates song now and queues the rating"""
+        if song.rating != rating:
+            self._update(song, rating=rating)
+            song.rating = rating
+
+    def set_tired(self, song):
+        if not song.tired:
+            self._update(song, tired=True)
+            song.tired = True
+
+    def bookmark(self, song):
+        self._update(song, bookmark=True)
+
+    def bookmark_artist(self, song):
+        self._update(song, bookmarkArtist=True)
+
+    def _done(self, token, **changes):
+        # Records a step that reached Pandora
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                return
+            entry.update(changes)
+            if not self._is_pending(entry) and token not in self._sending:
+                del self._entries[token]
+            self._save()
+
+    def _finish(self, token):
+        with self._lock:
+            self._sending.discard(token)
+            entry = self._entries.get(token)
+            if entry is not None and not self._is_pending(entry):
+                del self._entries[token]
+                self._save()
+
+    def _reject(self, token, step, sent):
+        """Forgets a step Pandora refused, unless it was queued again since it was sent
+
+        :param sent: The entry as it was sent
+        :returns: The rating Pandora has
+        """
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                return sent['sentRating']
+            if step != 'rating':
+                entry[step] = False
+            elif entry['rating'] == sent['rating']:
+                entry['rating'] = entry['sentRating']
+            self._save()
+            return entry['sentRating']
+
+    def revert(self, song, step, rating):
+        """Puts song back the way Pandora has it after it rejected step
+
+        Call it from the main loop with what :py:meth:`flush` returned. Nothing
+        is changed if the step was queued again since.
+
+        :param rating: The rating Pandora has
+        :returns: True if song changed
+        """
+        with self._lock:
+            entry = self._entries.get(song.trackToken)
+            entry = dict(entry) if entry is not None else None
+        if step == 'rating':
+            if (entry is not None and entry['rating'] != rating) or song.rating == rating:
+                return False
+            song.rating = rating
+            return True
+        if step == 'tired':
+            if (entry is not None and entry['tired']) or not song.tired:
+                return False
+            song.tired = False
+            return True
+        # Bookmarks don't show on the song.
+        return False
+
+    def _send_rating(self, entry):
+        token = entry['trackToken']
+        rating = entry['rating']
+        station = self.pandora.get_station_by_id(entry['stationId'])
+        if station is not None:
+            station.transformIfShared()
+            station_token = station.idToken
+        else:
+            station_token = entry['stationToken']
+
+        if rating == RATE_NONE:
+            feedback_id = entry['feedbackId']
+            if not feedback_id:
+                # We need a feedbackId, get one by re-rating the song.
+                opposite = RATE_BAN if entry['sentRating'] == RATE_LOVE else RATE_LOVE
+                feedback_id = self.pandora.add_feedback(token, opposite)
+                self._done(token, sentRating=opposite, feedbackId=feedback_id)
+            self.pandora.delete_feedback(station_token, feedback_id)
+            feedback_id = None
+        else:
+            feedback_id = self.pandora.add_feedback(token, rating)
+
+        self._done(token, sentRating=rating, feedbackId=feedback_id)
+        song = self._songs.get(token)
+        if song is not None:
+            song.feedbackId = feedback_id
+
+    def _send(self, entry):
+        """Sends the pending steps of entry, one Pandora rejects doesn't stop the others
+
+        :returns: [(step, rating Pandora has)] for the rejected steps
+        """
+        token = entry['trackToken']
+        rejected = []
+        for step, method in _STEPS:
+            if step == 'rating':
+                if entry['rating'] == entry['sentRating']:
+                    continue
+            elif not entry[step]:
+                continue
+            try:
+                if step == 'rating':
+                    self._send_rating(entry)
+                else:
+                    self.pandora.json_call(method, {'trackToken': token})
+                    self._done(token, **{step: False})
+            except (PandoraNetError, PandoraAuthTokenInvalid):
+                raise
+            except PandoraError as e:
+                logging.warning('Dropping {} for {}: {}'.format(step, entry['songName'], e.message))
+                rejected.append((step, self._reject(token, step, entry)))
+        return rejected
+
+    def flush(self):
+        """Sends everything that is queued, this blocks so call it from a worker
+
+        Steps Pandora rejects are dropped, the rest of their entry is still sent.
+        Network errors leave everything unsent queued.
+
+        :returns: (entries still queued, [(song, step, rating)] for the rejected
+                  steps to pass to :py:meth:`revert`)
+        :raises PandoraNetError: If Pandora can't be reached, retry later
+        :raises PandoraAuthTokenInvalid: If the session expired, retry after reconnecting
+        """
+        if not self._flush_lock.acquire(blocking=False):
+            # Another worker is already at it.
+            return len(self), []
+        rejected = []
+        try:
+            with self._lock:
+                tokens = list(self._entries)
+            for token in tokens:
+                with self._lock:
+                    entry = self._entries.get(token)
+                    if entry is None:
+                        continue
+                    # Changes made while this is sent are picked up by the next flush.
+                    entry = dict(entry)
+                    self._sending.add(token)
+                try:
+                    steps = self._send(entry)
+                finally:
+                    self._finish(token)
+                song = self._songs.get(token)
+                if song is not None:
+                    rejected.extend((song, step, rating) for step, rating in steps)
+            return len(self), rejected
+        finally:
+            self._flush_lock.release()
@@ -18,23 +18,41 @@
 See http://6xq.net/playground/pandora-apidoc/json/ for API documentation.
 """
 
-from .blowfish import Blowfish
-# from Crypto.Cipher import Blowfish
-from xml.dom import minidom
+from .blowfish import set_key_schedule_dir
+from .cipher import new_cipher
+import copy
+import hashlib
 import re
 import json
 import logging
+import threading
 import time
 import urllib.request, urllib.parse, urllib.error
-import codecs
+import http.client
 import ssl
 import os
 from enum import IntEnum
 from socket import error as SocketError
+from socket import timeout as SocketTimeout
 
 from . import data
+from .titles import TitleCache, lookup_song_title, CACHE_FILE as TITLE_CACHE_FILE
+from .transport import ConnectionPool, HTTPStatusError
+from ..util import atomic_write
 
 HTTP_TIMEOUT = 30
+# Pandora doesn't say how long auth tokens last, log in again in the background
+# well before they are likely to be rejected.
+SESSION_REFRESH_AGE = 60*60
+# The parts of user.getStationList results that Station uses, all that's cached on disk
+STATION_CACHE_FIELDS = ('stationId', 'stationToken', 'isShared', 'isQuickMix', 'isThumbprint',
+                        'stationName', 'quickMixStationIds')
+
+# Everything a login sets, swapped in as a whole by reauthenticate()
+SESSION_ATTRS = (
+    'client', 'rpcUrl', 'blowfish_encode', 'blowfish_decode', 'partnerId', 'userId',
+    'partnerAuthToken', 'userAuthToken', 'time_offset', 'connected', 'isSubscriber', 'auth_time',
+)
 USER_AGENT = 'pithos'
 
 RATE_BAN = 'ban'
@@ -129,6 +147,14 @@ PLAYLIST_VALIDITY_TIME = 60*60
 
 NAME_COMPARE_REGEX = re.compile(r'[^A-Za-z0-9]')
 
+# Read only calls, identical ones made at the same time share a single request.
+# station.getPlaylist is left out as every call returns new songs.
+COALESCED_METHODS = frozenset({
+    'user.getStationList',
+    'user.getSettings',
+    'music.search',
+})
+
 class PandoraError(IOError):
     def __init__(self, message, status=None, submsg=None):
         self.status = status
@@ -140,8 +166,11 @@ class PandoraNetError(PandoraError): pass
 class PandoraAPIVersionError(PandoraError): pass
 class PandoraTimeout(PandoraNetError): pass
 
-def pad(s, l):
-    return s + b'\0' * (l - len(s))
+class _InflightCall:
+    def __init__(self):
+        self.done = threading.Event()
+        self.text = None
+        self.error = None
 
 class Pandora:
     """Access the Pandora API
@@ -157,67 +186,74 @@ class Pandora:
     """
     def __init__(self):
         self.opener = self.build_opener()
+        self.transport = ConnectionPool(self.build_ssl_context())
+        self.cache_dir = None
+        self.title_cache = TitleCache()
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
+        self.coalesce_stats = {'calls': 0, 'saved': 0}
         self.connected = False
         self.isSubscriber = False
+        self.auth_time = None
+        self._session_lock = threading.Lock()
+        # Bumped whenever a login starts or a session is swapped in
+        self.session_generation = 0
+        self.stations = []
+        self.stations_by_id = {}
+        self.stations_by_token = {}
+        # Bumped whenever stations are added, removed or refreshed
+        self.stations_generation = 0
+        self.station_cache_path = None
 
     def pandora_encrypt(self, s):
-        return b''.join([codecs.encode(self.blowfish_encode.encrypt(pad(s[i:i+8], 8)), 'hex_codec') for i in range(0, len(s), 8)])
+        return self.blowfish_encode.encrypt_hex(s)
 
     def pandora_decrypt(self, s):
-        return b''.join([self.blowfish_decode.decrypt(pad(codecs.decode(s[i:i+16], 'hex_codec'), 8)) for i in range(0, len(s), 16)]).rstrip(b'\x08')
+        return self.blowfish_decode.decrypt_hex(s).rstrip(b'\x08')
 
-    def json_call(self, method, args=None, https=False, blowfish=True):
+    def _build_request(self, method, args, https, blowfish):
+        """Returns the url and request body for an API call"""
         if not args:
             args = {}
+        # Use one consistent session even if reauthenticate() swaps in a new one meanwhile.
+        with self._session_lock:
+            partnerId, userId = self.partnerId, self.userId
+            partnerAuthToken, userAuthToken = self.partnerAuthToken, self.userAuthToken
+            rpcUrl, time_offset, blowfish_encode = self.rpcUrl, self.time_offset, self.blowfish_encode
+
         url_arg_strings = []
-        if self.partnerId:
-            url_arg_strings.append('partner_id=%s'%self.partnerId)
-        if self.userId:
-            url_arg_strings.append('user_id=%s'%self.userId)
-        if self.userAuthToken:
-            url_arg_strings.append('auth_token=%s'%urllib.parse.quote_plus(self.userAuthToken))
-        elif self.partnerAuthToken:
-            url_arg_strings.append('auth_token=%s'%urllib.parse.quote_plus(self.partnerAuthToken))
+        if partnerId:
+            url_arg_strings.append('partner_id=%s'%partnerId)
+        if userId:
+            url_arg_strings.append('user_id=%s'%userId)
+        if userAuthToken:
+            url_arg_strings.append('auth_token=%s'%urllib.parse.quote_plus(userAuthToken))
+        elif partnerAuthToken:
+            url_arg_strings.append('auth_token=%s'%urllib.parse.quote_plus(partnerAuthToken))
 
         url_arg_strings.append('method=%s'%method)
         protocol = 'https' if https else 'http'
-        url = protocol + self.rpcUrl + '&'.join(url_arg_strings)
-
-        if self.time_offset:
-            args['syncTime'] = int(time.time()+self.time_offset)
-        if self.userAuthToken:
-            args['userAuthToken'] = self.userAuthToken
-        elif self.partnerAuthToken:
-            args['partnerAuthToken'] = self.partnerAuthToken
+        url = protocol + rpcUrl + '&'.join(url_arg_strings)
+
+        if time_offset:
+            args['syncTime'] = int(time.time()+time_offset)
+        if userAuthToken:
+            args['userAuthToken'] = userAuthToken
+        elif partnerAuthToken:
+            args['partnerAuthToken'] = partnerAuthToken
         data = json.dumps(args).encode('utf-8')
 
         logging.debug(url)
         logging.debug(data)
 
         if blowfish:
-            data = self.pandora_encrypt(data)
+            data = blowfish_encode.encrypt_hex(data)
 
-        try:
-            req = urllib.request.Request(url, data, {'User-agent': USER_AGENT, 'Content-type': 'text/plain'})
-            with self.opener.open(req, timeout=HTTP_TIMEOUT) as response:
-                text = response.read().decode('utf-8')
-        except urllib.error.HTTPError as e:
-            logging.error("HTTP error: %s", e)
-            raise PandoraNetError(str(e))
-        except urllib.error.URLError as e:
-            logging.error("Network error: %s", e)
-            if e.reason.strerror == 'timed out':
-                raise PandoraTimeout("Network error", submsg="Timeout")
-            else:
-                raise PandoraNetError("Network error", submsg=e.reason.strerror)
-        except SocketError as e:
-            try:
-                error_string = os.strerror(e.errno)
-            except (TypeError, ValueError):
-                error_string = "Unknown Error"
-            logging.error("Network Socket Error: %s", error_string)
-            raise PandoraNetError("Network Socket Error", submsg=error_string)
+        return url, data
 
+    @staticmethod
+    def _parse_response(text):
+        """Returns the result of an API call or raises the matching PandoraError"""
         logging.debug(text)
 
         tree = json.loads(text)
@@ -246,6 +282,85 @@ class Pandora:
         if 'result' in tree:
             return tree['result']
 
+    def _coalesce_key(self, method, args, https, blowfish):
+        """Identifies identical calls to a method in COALESCED_METHODS, None for other methods
+
+        Must be called before _build_request() adds the syncTime and auth token to args.
+        """
+        if method not in COALESCED_METHODS:
+            return None
+        return (method, json.dumps(args or {}, sort_keys=True), https, blowfish,
+                self.userAuthToken or self.partnerAuthToken)
+
+    def json_call(self, method, args=None, https=False, blowfish=True):
+        """Calls method with args and returns the result
+
+        Calls to methods in :py:data:`COALESCED_METHODS` made while an identical
+        one is in flight wait for it and get their own copy of its result.
+        """
+        key = self._coalesce_key(method, args, https, blowfish)
+        if key is None:
+            return self._parse_response(self._fetch(method, args, https, blowfish))
+
+        with self._inflight_lock:
+            self.coalesce_stats['calls'] += 1
+            call = self._inflight.get(key)
+            leader = call is None
+            if leader:
+                call = self._inflight[key] = _InflightCall()
+            else:
+                self.coalesce_stats['saved'] += 1
+
+        if leader:
+            try:
+                call.text = self._fetch(method, args, https, blowfish)
+            except Exception as e:
+                call.error = e
+                raise
+            finally:
+                with self._inflight_lock:
+                    del self._inflight[key]
+                call.done.set()
+        else:
+            logging.debug('%s: joined the call in flight, %i round trips saved so far',
+                          method, self.coalesce_stats['saved'])
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+        # Everyone parses the text so no two callers share mutable results.
+        return self._parse_response(call.text)
+
+    def _fetch(self, method, args, https, blowfish):
+        """Sends an API call and returns the response text"""
+        url, data = self._build_request(method, args, https, blowfish)
+
+        try:
+            body, timings = self.transport.post(url, data, {'User-agent': USER_AGENT, 'Content-type': 'text/plain'},
+                                                HTTP_TIMEOUT)
+            text = body.decode('utf-8')
+        except HTTPStatusError as e:
+            logging.error("HTTP error: %s", e)
+            raise PandoraNetError(str(e))
+        except SocketTimeout as e:
+            logging.error("Network error: %s", e)
+            raise PandoraTimeout("Network error", submsg="Timeout")
+        except SocketError as e:
+            try:
+                error_string = e.strerror or os.strerror(e.errno)
+            except (TypeError, ValueError):
+                error_string = "Unknown Error"
+            logging.error("Network Socket Error: %s", error_string)
+            raise PandoraNetError("Network Socket Error", submsg=error_string)
+        except http.client.HTTPException as e:
+            logging.error("HTTP error: %s", e)
+            raise PandoraNetError("Network error", submsg=str(e) or type(e).__name__)
+
+        logging.debug('%s: connect %.1fms, tls %.1fms, ttfb %.1fms, total %.1fms%s', method,
+                      timings.connect * 1000, timings.tls * 1000, timings.ttfb * 1000, timings.total * 1000,
+                      ' (reused connection)' if timings.reused else '')
+
+        return text
+
     def set_audio_quality(self, fmt):
         """Set the desired audio quality
 
@@ -255,6 +370,60 @@ class Pandora:
         """
         self.audio_quality = fmt
 
+    def set_cache_dir(self, path):
+        """Set the directory used to keep data that is expensive to recreate between sessions
+
+        :param path: A directory that may not exist yet, or None to keep everything in memory
+        """
+        self.cache_dir = path
+        set_key_schedule_dir(path)
+        self.title_cache.set_path(os.path.join(path, TITLE_CACHE_FILE) if path else None)
+
+    def set_station_cache(self, account):
+        """Keep the station list of account on disk, see :py:meth:`load_cached_stations`
+
+        :param account: Identifies the user, like their email, None stops caching
+        """
+        if account and self.cache_dir:
+            digest = hashlib.sha1(account.encode('utf-8')).hexdigest()
+            self.station_cache_path = os.path.join(self.cache_dir, 'stations-{}.json'.format(digest))
+        else:
+            self.station_cache_path = None
+
+    def load_cached_stations(self):
+        """Sets :py:attr:`stations` from the last list :py:meth:`get_stations` got
+
+        They can be shown before logging in but nothing can be done with them until then.
+
+        :returns: The stations or None if nothing is cached
+        """
+        if not self.station_cache_path:
+            return None
+        try:
+            with open(self.station_cache_path, 'r', encoding='utf-8') as f:
+                stations = json.load(f)
+            return self._set_stations(stations, cache=False)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, TypeError, KeyError) as e:
+            logging.warning('Ignoring unreadable station cache: {}'.format(e))
+            return None
+
+    def _save_station_cache(self, stations):
+        compact = [{k: d[k] for k in STATION_CACHE_FIELDS if k in d} for d in stations]
+        try:
+            with atomic_write(self.station_cache_path, 'w', prefix='.stations-', encoding='utf-8') as f:
+                json.dump(compact, f, separators=(',', ':'))
+        except OSError as e:
+            logging.warning('Failed to store station cache: {}'.format(e))
+
+    @staticmethod
+    def build_ssl_context():
+        """Creates a ssl.SSLContext that also trusts the CA used by internal-tuner.pandora.com"""
+        ctx = ssl.create_default_context()
+        ctx.load_verify_locations(cadata=data.internal_cert)
+        return ctx
+
     @staticmethod
     def build_opener(*handlers):
         """Creates a new opener
@@ -262,13 +431,22 @@ class Pandora:
         Wrapper around urllib.request.build_opener() that adds
         a custom ssl.SSLContext for use with internal-tuner.pandora.com
         """
-        ctx = ssl.create_default_context()
-        ctx.load_verify_locations(cadata=data.internal_cert)
-        https = urllib.request.HTTPSHandler(context=ctx)
+        https = urllib.request.HTTPSHandler(context=Pandora.build_ssl_context())
         return urllib.request.build_opener(https, *handlers)
 
     def set_url_opener(self, opener):
+        """Use the proxies configured on opener for API calls
+
+        API calls go through :py:attr:`transport`, which keeps connections
+        alive between calls, so only the opener's proxy settings are used.
+        """
         self.opener = opener
+        for handler in opener.handlers:
+            if isinstance(handler, urllib.request.ProxyHandler):
+                self.transport.set_proxies(handler.proxies)
+                break
+        else:
+            self.transport.set_proxies({})
 
     def connect(self, client, user, password):
         """Connect to the Pandora API and log the user in
@@ -277,34 +455,158 @@ class Pandora:
         :param user:     The user's login email
         :param password: The user's login password
         """
+        self.partner_login(client)
+        self.user_login(user, password)
+
+    def partner_login(self, client):
+        """The first half of :py:meth:`connect`
+
+        It doesn't need the user's credentials so it can run while they are looked up.
+        """
+        self._reset_session(client)
+        partner = self.json_call('auth.partnerLogin', self._partner_login_args(client), https=True, blowfish=False)
+        self._set_partner(partner)
+
+    def user_login(self, user, password):
+        """The second half of :py:meth:`connect`, :py:meth:`partner_login` must have succeeded"""
+        auth_args = {'username': user, 'password': password, 'loginType': 'user', 'returnIsSubscriber': True}
+        user = self.json_call('auth.userLogin', auth_args, https=True)
+        self._set_user(user)
+
+    def reauthenticate(self, client, user, password, generation=None):
+        """Log in again without disturbing calls made meanwhile
+
+        The new session is built on a copy and swapped in at once when it's
+        ready, until then calls keep using the current one. If another login
+        replaced the session in the meantime the new one is thrown away.
+
+        :param generation: The :py:attr:`session_generation` to replace, by default the current one
+        :returns: True if the new session was swapped in
+        """
+        if generation is None:
+            with self._session_lock:
+                generation = self.session_generation
+        fresh = copy.copy(self)
+        fresh.connect(client, user, password)
+        if not self._swap_session(fresh, generation):
+            logging.info('Discarded the new session, the session changed while logging in')
+            return False
+        logging.info('Swapped in a new session')
+        return True
+
+    def _swap_session(self, other, generation=None):
+        """Makes other's session ours
+
+        :param generation: Only swap if :py:attr:`session_generation` is still this
+        :returns: True if it was swapped in
+        """
+        with self._session_lock:
+            if generation is not None and generation != self.session_generation:
+                return False
+            for attr in SESSION_ATTRS:
+                setattr(self, attr, getattr(other, attr))
+            self.session_generation += 1
+            return True
+
+    def export_session(self):
+        """Returns the session as a string for :py:meth:`restore_session`, None if not connected
+
+        It holds the auth tokens so store it somewhere safe.
+        """
+        if not self.connected:
+            return None
+        with self._session_lock:
+            return json.dumps({
+                'client': self._client_digest(self.client),
+                'partnerId': self.partnerId,
+                'userId': self.userId,
+                'partnerAuthToken': self.partnerAuthToken,
+                'userAuthToken': self.userAuthToken,
+                'timeOffset': self.time_offset,
+                'isSubscriber': self.isSubscriber,
+                'authTime': self.auth_time,
+            })
+
+    def restore_session(self, session, client):
+        """Resumes a session from :py:meth:`export_session` without logging in
+
+        Nothing is sent to Pandora, if the tokens have expired the first call
+        raises :py:exc:`PandoraAuthTokenInvalid` and :py:meth:`connect` is needed.
+
+        :param session: The string returned by :py:meth:`export_session`
+        :param client:  The client the session must have been created with
+        :returns: True if the session was restored
+        """
+        try:
+            d = json.loads(session)
+            if d['client'] != self._client_digest(client):
+                logging.info('Saved session is for another client')
+                return False
+            fresh = copy.copy(self)
+            fresh._reset_session(client)
+            fresh.partnerId = d['partnerId']
+            fresh.userId = d['userId']
+            fresh.partnerAuthToken = d['partnerAuthToken']
+            fresh.userAuthToken = d['userAuthToken']
+            fresh.time_offset = d['timeOffset']
+            fresh.isSubscriber = d['isSubscriber']
+            fresh.auth_time = d['authTime']
+        except (ValueError, TypeError, KeyError) as e:
+            logging.warning('Ignoring invalid saved session: {}'.format(e))
+            return False
+        fresh.connected = True
+        self._swap_session(fresh)
+        logging.info('Restored saved session')
+        return True
+
+    @staticmethod
+    def _client_digest(client):
+        return hashlib.sha1(json.dumps(client, sort_keys=True).encode('utf-8')).hexdigest()
+
+    @property
+    def session_age(self):
+        """Seconds since the user logged in, None if not connected"""
+        if not self.connected or self.auth_time is None:
+            return None
+        # Wall clock time so time spent suspended counts
+        return time.time() - self.auth_time
+
+    def _reset_session(self, client):
+        with self._session_lock:
+            self.session_generation += 1
         self.connected = False
         self.partnerId = self.userId = self.partnerAuthToken = None
         self.userAuthToken = self.time_offset = None
 
+        self.client = client
         self.rpcUrl = client['rpcUrl']
-        self.blowfish_encode = Blowfish(client['encryptKey'].encode('utf-8'))
-        self.blowfish_decode = Blowfish(client['decryptKey'].encode('utf-8'))
+        self.blowfish_encode = new_cipher(client['encryptKey'].encode('utf-8'))
+        self.blowfish_decode = new_cipher(client['decryptKey'].encode('utf-8'))
 
-        partner = self.json_call('auth.partnerLogin', {
+    @staticmethod
+    def _partner_login_args(client):
+        return {
             'deviceModel': client['deviceModel'],
             'username': client['username'], # partner username
             'password': client['password'], # partner password
             'version': client['version']
-            },https=True, blowfish=False)
+        }
 
+    def _set_partner(self, partner):
         self.partnerId = partner['partnerId']
         self.partnerAuthToken = partner['partnerAuthToken']
 
         pandora_time = int(self.pandora_decrypt(partner['syncTime'].encode('utf-8'))[4:14])
         self.time_offset = pandora_time - time.time()
         logging.info("Time offset is %s", self.time_offset)
-        auth_args = {'username': user, 'password': password, 'loginType': 'user', 'returnIsSubscriber': True}
-        user = self.json_call('auth.userLogin', auth_args, https=True)
+
+    def _set_user(self, user):
         self.userId = user['userId']
         self.userAuthToken = user['userAuthToken']
 
         self.connected = True
         self.isSubscriber = user['isSubscriber']
+        self.auth_time = time.time()
 
     @property
     def explicit_content_filter_state(self):
@@ -327,9 +629,25 @@ class Pandora:
         logging.info('Explicit Content Filter set to: %s' %(state))
 
     def get_stations(self, *ignore):
-        stations = self.json_call('user.getStationList')['stations']
+        return self._set_stations(self.json_call('user.getStationList')['stations'])
+
+    def _set_stations(self, stations, cache=True):
+        if cache and self.station_cache_path:
+            self._save_station_cache(stations)
         self.quickMixStationIds = None
-        self.stations = [Station(self, i) for i in stations]
+        # Stations we already have are updated in place so references to them stay valid.
+        previous = self.stations_by_id
+        self.stations = []
+        for d in stations:
+            station = previous.get(d['stationId'])
+            if station is None:
+                station = Station(self, d)
+            else:
+                station.update(d)
+            self.stations.append(station)
+        self.stations_by_id = {station.id: station for station in self.stations}
+        self.stations_by_token = {station.idToken: station for station in self.stations}
+        self.stations_generation += 1
 
         if self.quickMixStationIds:
             for i in self.stations:
@@ -360,28 +678,38 @@ class Pandora:
 
     def add_station_by_music_id(self, musicid):
         d = self.json_call('station.createStation', {'musicToken': musicid})
-        station = Station(self, d)
-        if not self.get_station_by_id(station.id):
-            self.stations.append(station)
-        return station
+        return self._add_station(d)
 
     def add_station_by_track_token(self, trackToken, musicType):
         d = self.json_call('station.createStation', {'trackToken': trackToken, 'musicType': musicType})
+        return self._add_station(d)
+
+    def _add_station(self, d):
         station = Station(self, d)
-        if not self.get_station_by_id(station.id):
+        if station.id not in self.stations_by_id:
             self.stations.append(station)
+            self.stations_by_id[station.id] = station
+            self.stations_by_token[station.idToken] = station
+            self.stations_generation += 1
         return station
 
+    def _remove_station(self, station):
+        self.stations.remove(station)
+        del self.stations_by_id[station.id]
+        self.stations_by_token.pop(station.idToken, None)
+        self.stations_generation += 1
+
     def delete_station(self, station):
-        if self.get_station_by_id(station.id):
+        if station.id in self.stations_by_id:
             logging.info("pandora: Deleting Station")
             self.json_call('station.deleteStation', {'stationToken': station.idToken})
-            self.stations.remove(station)
+            self._remove_station(station)
 
     def get_station_by_id(self, id):
-        for i in self.stations:
-            if i.id == id:
-                return i
+        return self.stations_by_id.get(id)
+
+    def get_station_by_token(self, token):
+        return self.stations_by_token.get(token)
 
     def add_feedback(self, trackToken, rating):
         logging.info("pandora: addFeedback")
@@ -395,7 +723,10 @@ class Pandora:
 class Station:
     def __init__(self, pandora, d):
         self.pandora = pandora
+        self.update(d)
 
+    def update(self, d):
+        """Sets everything from a user.getStationList or station.createStation result"""
         self.id = d['stationId']
         self.idToken = d['stationToken']
         self.isCreator = not d['isShared']
@@ -425,7 +756,7 @@ class Station:
                         'additionalAudioUrl': 'HTTP_32_AACPLUS,HTTP_128_MP3',
                     }, https=True)['items']
 
-        return [Song(self.pandora, i, playlist_time) for i in playlist if 'songName' in i] 
+        return [Song(self.pandora, i, playlist_time) for i in playlist if 'songName' in i]
 
     @property
     def info_url(self):
@@ -469,6 +800,8 @@ class Song:
         self.trackToken = d['trackToken']
         self.rating = RATE_LOVE if d['songRating'] == 1 else RATE_NONE # banned songs won't play, so we don't care about them
         self.stationId = d['stationId']
+        self._station = None
+        self._station_generation = None
         self.songName = d['songName']
         self.songDetailURL = d['songDetailUrl']
         self.songExplorerUrl = d['songExplorerUrl']
@@ -476,6 +809,8 @@ class Song:
         self.trackLength = d['trackLength']
         self.trackGain = float(d.get('trackGain', '0.0'))
         self.audioUrlMap = d['audioUrlMap']
+        # Set by compact()
+        self.compacted = False
 
         # Optionally we requested more URLs
         if len(d.get('additionalAudioUrl', [])) == 2:
@@ -501,20 +836,51 @@ class Song:
         clean_expl_name = NAME_COMPARE_REGEX.sub('', explorer_name).lower()
         clean_name = NAME_COMPARE_REGEX.sub('', self.songName).lower()
 
-        if clean_name == clean_expl_name:
-            self.title = self.songName
-        else:
-            try:
-                with urllib.request.urlopen(self.songExplorerUrl) as x, minidom.parseString(x.read()) as dom:
-                    attr_value = dom.getElementsByTagName('songExplorer')[0].attributes['songTitle'].value
+        # For film scores and the like they differ and only the song explorer
+        # document has the real title, see lookup_title().
+        self.title = self.songName
+        self.needs_title_lookup = False
+        if clean_name != clean_expl_name:
+            explorer_title = pandora.title_cache.get(self.songExplorerUrl)
+            if explorer_title is not None:
+                self.title = self._title_from_explorer(explorer_title)
+            else:
+                self.needs_title_lookup = True
 
-                # Pandora stores their titles for film scores and the like as 'Score name: song name'
-                self.title = attr_value.replace('{0}: '.format(self.songName), '', 1)
-            except:
-                self.title = self.songName
+    def _title_from_explorer(self, explorer_title):
+        # Pandora stores their titles for film scores and the like as 'Score name: song name'
+        return explorer_title.replace('{0}: '.format(self.songName), '', 1)
+
+    def lookup_title(self, cancel_token=None):
+        """Fetches the title from songExplorerUrl
+
+        This blocks on the network so call it from a worker, it falls back to songName on errors.
+
+        :param cancel_token: Checked between chunks of the download, stops the lookup once cancelled
+        """
+        self.needs_title_lookup = False
+        try:
+            explorer_title = lookup_song_title(self.songExplorerUrl, HTTP_TIMEOUT, cancel_token)
+        except Exception as e:
+            if cancel_token is not None and cancel_token.cancelled:
+                self.needs_title_lookup = True
+                raise
+            logging.info('Failed to look up the title of {}: {}'.format(self.songName, e))
+            return self.songName
+        if explorer_title is None:
+            return self.songName
+        self.pandora.title_cache.put(self.songExplorerUrl, explorer_title)
+        return self._title_from_explorer(explorer_title)
+
+    def compact(self):
+        """Drops what is only needed to play the song, for songs that are kept as history"""
+        self.audioUrlMap = None
+        self.compacted = True
 
     @property
     def audioUrl(self):
+        if self.compacted:
+            return None
         quality = self.pandora.audio_quality
         try:
             q = self.audioUrlMap[quality]
@@ -529,7 +895,11 @@ class Song:
 
     @property
     def station(self):
-        return self.pandora.get_station_by_id(self.stationId)
+        # Looked up once per set of stations, which changes far less often than this is used.
+        if self._station_generation != self.pandora.stations_generation:
+            self._station = self.pandora.get_station_by_id(self.stationId)
+            self._station_generation = self.pandora.stations_generation
+        return self._station
 
     def get_duration_sec(self):
         if self.duration is not None:
@@ -574,10 +944,14 @@ class Song:
     def rating_str(self):
         return self.rating
 
+    def latest_start_time(self):
+        """The last time at which the rest of the song can be played before its playlist expires"""
+        return self.playlist_time + PLAYLIST_VALIDITY_TIME - (self.get_duration_sec() - self.get_position_sec())
+
     def is_still_valid(self):
         # Playlists are valid for 1 hour. A song is considered valid if there is enough time
         # to play the remaining duration of the song before the playlist expires.
-        return ((time.time() + (self.get_duration_sec() - self.get_position_sec())) - self.playlist_time) < PLAYLIST_VALIDITY_TIME
+        return time.time() < self.latest_start_time()
 
     def __repr__(self):
         return '<{}.{} {} "{}" by "{}" from "{}">'.format(
@@ -0,0 +1,174 @@
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: nil; -*-
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Song explorer title lookups
+
+Pandora only has the real title of film scores and the like in the song
+explorer document. The same songs come up again and again so the titles
+are kept in a small persistent LRU cache.
+"""
+
+import collections
+import json
+import logging
+import threading
+import urllib.request
+from xml.parsers import expat
+
+from ..util import atomic_write
+
+# Roughly 100 bytes per entry on disk
+MAX_ENTRIES = 2000
+CACHE_FILE = 'song-titles.json'
+CHUNK_SIZE = 4096
+
+
+class _Found(Exception):
+    pass
+
+
+def parse_song_title(stream, cancel_token=None):
+    """Returns the songTitle attribute of the first songExplorer element in stream
+
+    The document is parsed as it is read and reading stops at that element.
+
+    :param stream:       A file like object returning bytes
+    :param cancel_token: Checked between chunks of the document
+    :returns: The title or None if there is no such element
+    """
+    def start_element(name, attrs):
+        if name == 'songExplorer':
+            raise _Found(attrs.get('songTitle'))
+
+    parser = expat.ParserCreate()
+    parser.StartElementHandler = start_element
+    try:
+        while True:
+            if cancel_token is not None:
+                cancel_token.check()
+            chunk = stream.read(CHUNK_SIZE)
+            parser.Parse(chunk, not chunk)
+            if not chunk:
+                return None
+    except _Found as found:
+        return found.args[0]
+
+
+def cache_key(song_explorer_url):
+    """The query holds no part of the title so it's left out of the key"""
+    return song_explorer_url.split('?')[0]
+
+
+class TitleCache:
+    """A thread safe LRU mapping of song explorer urls to titles
+
+    :param path:        JSON file the cache is kept in, None keeps it in memory only
+    :param max_entries: How many titles to keep, the least recently used are dropped first
+    """
+    def __init__(self, path=None, max_entries=MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self._titles = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        # Called with the lock held
+        if self._titles is not None:
+            return
+        self._titles = collections.OrderedDict()
+        if not self.path:
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                # Stored least recently used first
+                entries = json.load(f)
+            for key, title in entries:
+                self._titles[key] = title
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, TypeError) as e:
+            logging.warning('Ignoring unreadable song title cache: {}'.format(e))
+            self._titles.clear()
+
+    def _save(self):
+        # Called with the lock held
+        if not self.path:
+            return
+        try:
+            with atomic_write(self.path, 'w', prefix='.song-titles-', encoding='utf-8') as f:
+                json.dump(list(self._titles.items()), f)
+        except OSError as e:
+            logging.warning('Failed to store song title cache: {}'.format(e))
+
+    def set_path(self, path):
+        with self._lock:
+            self.path = path
+            self._titles = None
+
+    def get(self, song_explorer_url):
+        """Returns the cached title or None"""
+        key = cache_key(song_explorer_url)
+        with self._lock:
+            self._load()
+            title = self._titles.get(key)
+            if title is not None:
+                # The new order is written out with the next put()
+                self._titles.move_to_end(key)
+            return title
+
+    def put(self, song_explorer_url, title):
+        key = cache_key(song_explorer_url)
+        with self._lock:
+            self._load()
+            self._titles[key] = title
+            self._titles.move_to_end(key)
+            while len(self._titles) > self.max_entries:
+                self._titles.popitem(last=False)
+            self._save()
+
+
+def lookup_song_title(song_explorer_url, timeout, cancel_token=None):
+    """Fetches the songTitle from song_explorer_url, this blocks
+
+    :param cancel_token: Checked between chunks of the download
+    :returns: The title or None if the document has none
+    """
+    with urllib.request.urlopen(song_explorer_url, timeout=timeout) as f:
+        return parse_song_title(f, cancel_token)
+
+
+if __name__ == '__main__':
+    # Compares the streaming parser to a full DOM parse: python3 -m pithos.pandora.titles
+    import io
+    import timeit
+    from xml.dom import minidom
+
+    document = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<songExplorer songTitle="Star Wars: Main Title" artistName="John Williams" '
+                'musicId="S1234" isSubscriber="false">'
+                + '<similar><song name="x" artist="y" musicId="S1"/></similar>' * 200
+                + '</songExplorer>').encode('utf-8')
+
+    def with_dom():
+        with minidom.parseString(document) as dom:
+            return dom.getElementsByTagName('songExplorer')[0].attributes['songTitle'].value
+
+    def with_expat():
+        return parse_song_title(io.BytesIO(document))
+
+    assert with_dom() == with_expat() == 'Star Wars: Main Title'
+    assert parse_song_title(io.BytesIO(b'<error/>')) is None
+    for name, fn in (('minidom', with_dom), ('expat', with_expat)):
+        runs = 200
+        elapsed = min(timeit.repeat(fn, number=runs, repeat=3)) / runs
+        print('{:8} {:8.1f}µs per {} byte document'.format(name, elapsed * 1e6, len(document)))
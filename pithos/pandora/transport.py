@@ -0,0 +1,215 @@
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: nil; -*-
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Persistent HTTP/1.1 transport for the Pandora JSON API
+
+urllib opens a new TCP connection, and for https a new TLS session, for
+every request. The :py:class:`ConnectionPool` keeps a few idle connections
+per scheme and host around so consecutive API calls can skip both.
+"""
+
+import base64
+import collections
+import http.client
+import logging
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+# How many idle connections we keep per (scheme, host, port)
+MAX_IDLE_PER_HOST = 2
+# Drop idle connections before the server is likely to close them on us
+IDLE_TIMEOUT = 30
+
+# Errors that mean a reused connection was closed by the server
+# while it sat idle in the pool.
+_STALE_CONNECTION_ERRORS = (
+    http.client.RemoteDisconnected,
+    http.client.BadStatusLine,
+    ConnectionResetError,
+    ConnectionAbortedError,
+    BrokenPipeError,
+)
+
+RequestTimings = collections.namedtuple('RequestTimings', ['connect', 'tls', 'ttfb', 'total', 'reused'])
+
+
+class HTTPStatusError(IOError):
+    def __init__(self, status, reason):
+        super().__init__('HTTP Error {}: {}'.format(status, reason))
+        self.status = status
+        self.reason = reason
+
+
+class _TimedHTTPConnection(http.client.HTTPConnection):
+    tls_time = 0.0
+
+    def connect(self):
+        start = time.perf_counter()
+        super().connect()
+        self.connect_time = time.perf_counter() - start
+
+
+class _TimedHTTPSConnection(http.client.HTTPSConnection):
+    def connect(self):
+        # Same as HTTPSConnection.connect() but times the TCP connect
+        # (including any proxy CONNECT) and the TLS handshake separately.
+        start = time.perf_counter()
+        http.client.HTTPConnection.connect(self)
+        self.connect_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        server_hostname = self._tunnel_host or self.host
+        self.sock = self._context.wrap_socket(self.sock, server_hostname=server_hostname)
+        self.tls_time = time.perf_counter() - start
+
+
+class ConnectionPool:
+    """A small thread safe pool of keep-alive connections
+
+    :param ssl_context: The :py:class:`ssl.SSLContext` used for https connections
+    :param proxies:     A scheme to proxy url mapping as used by :py:class:`urllib.request.ProxyHandler`,
+                        None uses the system proxies
+    """
+    def __init__(self, ssl_context, proxies=None):
+        self.ssl_context = ssl_context
+        self.proxies = urllib.request.getproxies() if proxies is None else proxies
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def set_proxies(self, proxies):
+        """Change the proxies, dropping every pooled connection"""
+        with self._lock:
+            self.proxies = proxies
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for conn, last_used in connections:
+                conn.close()
+
+    def close(self):
+        self.set_proxies(self.proxies)
+
+    def _proxy_for(self, scheme, host):
+        proxy = self.proxies.get(scheme)
+        if not proxy or urllib.request.proxy_bypass(host):
+            return None, None
+        if '://' not in proxy:
+            proxy = 'http://' + proxy
+        parts = urllib.parse.urlsplit(proxy)
+        auth = None
+        if parts.username is not None:
+            creds = '{}:{}'.format(urllib.parse.unquote(parts.username),
+                                   urllib.parse.unquote(parts.password or ''))
+            auth = 'Basic ' + base64.b64encode(creds.encode('utf-8')).decode('ascii')
+        return (parts.hostname, parts.port or 80), auth
+
+    def _new_connection(self, scheme, host, port, timeout):
+        proxy, proxy_auth = self._proxy_for(scheme, host)
+        if scheme == 'https':
+            if proxy:
+                conn = _TimedHTTPSConnection(proxy[0], proxy[1], timeout=timeout, context=self.ssl_context)
+                headers = {'Proxy-Authorization': proxy_auth} if proxy_auth else None
+                conn.set_tunnel(host, port, headers=headers)
+            else:
+                conn = _TimedHTTPSConnection(host, port, timeout=timeout, context=self.ssl_context)
+            conn.proxy_auth = None
+        else:
+            if proxy:
+                conn = _TimedHTTPConnection(proxy[0], proxy[1], timeout=timeout)
+            else:
+                conn = _TimedHTTPConnection(host, port, timeout=timeout)
+            conn.proxy_auth = proxy_auth
+        conn.via_proxy = proxy is not None and scheme == 'http'
+        return conn
+
+    def _checkout(self, key):
+        now = time.monotonic()
+        with self._lock:
+            connections = self._idle.get(key)
+            while connections:
+                conn, last_used = connections.pop()
+                if now - last_used < IDLE_TIMEOUT:
+                    return conn
+                conn.close()
+        return None
+
+    def _checkin(self, key, conn):
+        with self._lock:
+            connections = self._idle.setdefault(key, [])
+            # Evict anything that went stale while we were busy.
+            now = time.monotonic()
+            for stale in [c for c in connections if now - c[1] >= IDLE_TIMEOUT]:
+                connections.remove(stale)
+                stale[0].close()
+            if len(connections) < MAX_IDLE_PER_HOST:
+                connections.append((conn, now))
+                return
+        conn.close()
+
+    def post(self, url, data, headers, timeout):
+        """POST data to url reusing a pooled connection when possible
+
+        :returns: A tuple of the response body and its :py:class:`RequestTimings`
+        :raises HTTPStatusError: for non 200 responses
+        :raises OSError: for network errors
+        """
+        parts = urllib.parse.urlsplit(url)
+        scheme = parts.scheme
+        host = parts.hostname
+        port = parts.port or (443 if scheme == 'https' else 80)
+        key = (scheme, host, port)
+
+        conn = self._checkout(key)
+        if conn is not None:
+            try:
+                return self._request(key, conn, True, url, data, headers)
+            except _STALE_CONNECTION_ERRORS as e:
+                logging.debug('Pooled connection to %s was closed (%s), reconnecting', host, e)
+                conn.close()
+
+        conn = self._new_connection(scheme, host, port, timeout)
+        try:
+            return self._request(key, conn, False, url, data, headers)
+        except BaseException:
+            conn.close()
+            raise
+
+    def _request(self, key, conn, reused, url, data, headers):
+        start = time.perf_counter()
+        if conn.via_proxy:
+            target = url
+        else:
+            parts = urllib.parse.urlsplit(url)
+            target = parts.path + ('?' + parts.query if parts.query else '')
+        headers = dict(headers)
+        if conn.proxy_auth:
+            headers['Proxy-Authorization'] = conn.proxy_auth
+
+        conn.connect_time = conn.tls_time = 0.0
+        if conn.sock is None:
+            conn.connect()
+        conn.request('POST', target, data, headers)
+        response = conn.getresponse()
+        ttfb = time.perf_counter() - start
+        body = response.read()
+        timings = RequestTimings(conn.connect_time, conn.tls_time, ttfb, time.perf_counter() - start, reused)
+
+        if response.will_close:
+            conn.close()
+        else:
+            self._checkin(key, conn)
+
+        if response.status != 200:
+            raise HTTPStatusError(response.status, response.reason)
+        return body, timings
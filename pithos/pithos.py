@@ -13,7 +13,9 @@
 # with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import collections
 import contextlib
+import copy
 import html
 import json
 import logging
@@ -22,9 +24,6 @@ import re
 import os
 import sys
 import time
-import tempfile
-import urllib.error
-import urllib.parse
 import urllib.request
 from enum import Enum
 
@@ -33,18 +32,21 @@ gi.require_version('Gst', '1.0')
 gi.require_version('GstAudio', '1.0')
 gi.require_version('GstPbutils', '1.0')
 from gi.repository import Gst, GstAudio, GstPbutils, GObject, Gtk, Gdk, Pango, GdkPixbuf, Gio, GLib
+import cairo
 from .gi_composites import GtkTemplate
 
 if Gtk.get_major_version() < 3 or Gtk.get_minor_version() < 14:
     sys.exit('Gtk 3.14 is required')
 
-from . import AboutPithosDialog, PreferencesPithosDialog, StationsDialog
+from . import AboutPithosDialog, PreferencesPithosDialog, StationsDialog, album_art
 from .StationsPopover import StationsPopover
-from .gobject_worker import GObjectWorker
+from .gobject_worker import CancelGroup, GObjectWorker, PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE, PRIORITY_PLAYBACK
 from .pandora import *
 from .pandora.data import *
+from .pandora.feedback import FeedbackQueue
 from .plugin import load_plugins
-from .util import parse_proxy, open_browser, SecretService, popup_at_pointer
+from .prefetch import Prefetcher
+from .util import parse_proxy, open_browser, SecretService, StartupTimeline, popup_at_pointer
 from .migrate_settings import maybe_migrate_settings
 
 try:
@@ -61,7 +63,14 @@ except AttributeError:
     RESAMPLER_FILTER_MODE_FULL = 1
 
 ALBUM_ART_SIZE = 96
+# Composited album art cells kept, a few screens worth of rows
+CELL_SURFACE_CACHE_SIZE = 64
 TEXT_X_PADDING = 12
+# Seconds to wait before sending queued feedback, and the longest we back off after failures
+FEEDBACK_FLUSH_DELAY = 2
+FEEDBACK_MAX_RETRY_DELAY = 300
+# How often we check whether the Pandora session is due a refresh
+SESSION_CHECK_INTERVAL = 5*60
 
 FALLBACK_BLACK = Gdk.RGBA(red=0.0, green=0.0, blue=0.0, alpha=1.0)
 FALLBACK_WHITE = Gdk.RGBA(red=1.0, green=1.0, blue=1.0, alpha=1.0)
@@ -109,6 +118,10 @@ class CellRendererAlbumArt(Gtk.CellRenderer):
         self.generic_audio_icon = None
         self.background = None
         self.rate_bg = None
+        # Device pixels per pixel of the icons above
+        self.scale = 1
+        # (pixbuf, icon, scale): the composited cell, most recently used last
+        self.surfaces = collections.OrderedDict()
 
     __gproperties__ = {
         'icon': (str, 'icon', 'icon', '', GObject.ParamFlags.READWRITE),
@@ -119,23 +132,37 @@ class CellRendererAlbumArt(Gtk.CellRenderer):
         setattr(self, pspec.name, value)
     def do_get_property(self, pspec):
         return getattr(self, pspec.name)
-    def do_render(self, ctx, widget, background_area, cell_area, flags):
+
+    @staticmethod
+    def paint_pixbuf(ctx, pixbuf, x, y, width):
+        """Paints pixbuf scaled to width pixels wide at x, y"""
+        ctx.save()
+        ctx.translate(x, y)
+        scale = width / pixbuf.get_width()
+        ctx.scale(scale, scale)
+        Gdk.cairo_set_source_pixbuf(ctx, pixbuf, 0, 0)
+        ctx.paint()
+        ctx.restore()
+
+    def composite(self, widget, scale):
+        """Draws the art and rating of the current row into a new surface"""
+        surface = widget.get_window().create_similar_image_surface(
+            cairo.FORMAT_ARGB32, ALBUM_ART_SIZE * scale, ALBUM_ART_SIZE * scale, scale)
+        ctx = cairo.Context(surface)
+        # Pixbufs may have more pixels than the cell on HiDPI screens,
+        # they're drawn at their logical size to keep the detail.
         if self.pixbuf is not None:
-            Gdk.cairo_set_source_pixbuf(ctx, self.pixbuf, cell_area.x, cell_area.y)
-            ctx.paint()
+            self.paint_pixbuf(ctx, self.pixbuf, 0, 0, ALBUM_ART_SIZE)
         else:
-            Gdk.cairo_set_source_pixbuf(ctx, self.background, cell_area.x, cell_area.y)
-            ctx.paint()
-            x = cell_area.x + (ALBUM_ART_SIZE - self.generic_audio_icon.get_width()) // 2
-            y = cell_area.y + (ALBUM_ART_SIZE - self.generic_audio_icon.get_height()) // 2
-            Gdk.cairo_set_source_pixbuf(ctx, self.generic_audio_icon, x, y)
-            ctx.paint()
+            self.paint_pixbuf(ctx, self.background, 0, 0, ALBUM_ART_SIZE)
+            width = self.generic_audio_icon.get_width() // self.scale
+            x = y = (ALBUM_ART_SIZE - width) // 2
+            self.paint_pixbuf(ctx, self.generic_audio_icon, x, y, width)
 
         if self.icon is not None:
-            x = cell_area.x + (cell_area.width - self.rate_bg.get_width()) # right
-            y = cell_area.y + (cell_area.height - self.rate_bg.get_height()) # bottom
-            Gdk.cairo_set_source_pixbuf(ctx, self.rate_bg, x, y)
-            ctx.paint()
+            width = self.rate_bg.get_width() // self.scale
+            x = y = ALBUM_ART_SIZE - width # right, bottom
+            self.paint_pixbuf(ctx, self.rate_bg, x, y, width)
 
             if self.icon == 'love':
                 rating_icon = self.love_icon
@@ -144,13 +171,27 @@ class CellRendererAlbumArt(Gtk.CellRenderer):
             elif self.icon == 'ban':
                 rating_icon = self.ban_icon
 
-            x = x + (rating_icon.get_width() // 2)
-            y = y + (rating_icon.get_height() // 2)
+            icon_width = rating_icon.get_width() // self.scale
+            x = x + (icon_width // 2)
+            y = y + (icon_width // 2)
+            self.paint_pixbuf(ctx, rating_icon, x, y, icon_width)
+        return surface
 
-            Gdk.cairo_set_source_pixbuf(ctx, rating_icon, x, y)
-            ctx.paint()
+    def do_render(self, ctx, widget, background_area, cell_area, flags):
+        # Scrolling redraws every visible row, reuse what was drawn before.
+        scale = widget.get_scale_factor()
+        key = self.pixbuf, self.icon, scale
+        surface = self.surfaces.get(key)
+        if surface is None:
+            surface = self.surfaces[key] = self.composite(widget, scale)
+            while len(self.surfaces) > CELL_SURFACE_CACHE_SIZE:
+                self.surfaces.popitem(last=False)
+        else:
+            self.surfaces.move_to_end(key)
+        ctx.set_source_surface(surface, cell_area.x, cell_area.y)
+        ctx.paint()
 
-    def update_icons(self, style_context):
+    def update_icons(self, style_context, scale=1):
         # Dynamically change the color of backgrounds and icons
         # to match the current theme at theme changes.
         # Attempt to look up the background and foreground colors
@@ -176,16 +217,22 @@ class CellRendererAlbumArt(Gtk.CellRenderer):
         fg_rgb = fg_color.to_string()
         bg_rgb = bg_color.to_string()
 
+        # Everything is loaded at scale times its size so it's sharp on HiDPI screens.
+        self.scale = scale
+        self.surfaces.clear()
+
         # Use our color values to create strings representing valid SVG's
         # for backgound and rate_bg, then load them with PixbufLoader.
         background = BACKGROUND_SVG.format(px=ALBUM_ART_SIZE, fg=fg_rgb).encode()
         rating_bg = RATING_BG_SVG.format(bg=bg_rgb).encode()
 
         with contextlib.closing(GdkPixbuf.PixbufLoader()) as loader:
+            loader.set_size(ALBUM_ART_SIZE * scale, ALBUM_ART_SIZE * scale)
             loader.write(background)
         self.background = loader.get_pixbuf()
 
         with contextlib.closing(GdkPixbuf.PixbufLoader()) as loader:
+            loader.set_size(20 * scale, 20 * scale)
             loader.write(rating_bg)
         self.rate_bg = loader.get_pixbuf()
 
@@ -194,23 +241,24 @@ class CellRendererAlbumArt(Gtk.CellRenderer):
         # Pithos requires an icon theme with symbolic icons.
 
         # Manually color audio-x-generic-symbolic 48px icon to be used as part of the "default cover".
-        info = current_theme.lookup_icon('audio-x-generic-symbolic', 48, 0)
+        info = current_theme.lookup_icon_for_scale('audio-x-generic-symbolic', 48, scale, 0)
         self.generic_audio_icon, was_symbolic = info.load_symbolic(bg_color, bg_color, bg_color, bg_color)
 
         # We request 24px icons because what we really want is 12px icons,
         # and they doesn't exist in many(or any?) icon themes. We then manually color
         # and scale them down to 12px.
-        info = current_theme.lookup_icon('emblem-favorite-symbolic', 24, 0)
+        size = 12 * scale
+        info = current_theme.lookup_icon_for_scale('emblem-favorite-symbolic', 24, scale, 0)
         icon, was_symbolic = info.load_symbolic(fg_color, fg_color, fg_color, fg_color)
-        self.love_icon = icon.scale_simple(12, 12, GdkPixbuf.InterpType.BILINEAR)
+        self.love_icon = icon.scale_simple(size, size, GdkPixbuf.InterpType.BILINEAR)
 
-        info = current_theme.lookup_icon('dialog-error-symbolic', 24, 0)
+        info = current_theme.lookup_icon_for_scale('dialog-error-symbolic', 24, scale, 0)
         icon, was_symbolic = info.load_symbolic(fg_color, fg_color, fg_color, fg_color)
-        self.ban_icon = icon.scale_simple(12, 12, GdkPixbuf.InterpType.BILINEAR)
+        self.ban_icon = icon.scale_simple(size, size, GdkPixbuf.InterpType.BILINEAR)
 
-        info = current_theme.lookup_icon('go-jump-symbolic', 24, 0)
+        info = current_theme.lookup_icon_for_scale('go-jump-symbolic', 24, scale, 0)
         icon, was_symbolic = info.load_symbolic(fg_color, fg_color, fg_color, fg_color)
-        self.tired_icon = icon.scale_simple(12, 12, GdkPixbuf.InterpType.BILINEAR)
+        self.tired_icon = icon.scale_simple(size, size, GdkPixbuf.InterpType.BILINEAR)
 
 @GtkTemplate(ui='/io/github/Pithos/ui/PithosWindow.ui')
 class PithosWindow(Gtk.ApplicationWindow):
@@ -225,6 +273,8 @@ class PithosWindow(Gtk.ApplicationWindow):
         "station-changed": (GObject.SignalFlags.RUN_FIRST, None, (GObject.TYPE_PYOBJECT,)),
         "stations-processed": (GObject.SignalFlags.RUN_FIRST, None, (GObject.TYPE_PYOBJECT,)),
         "station-added": (GObject.SignalFlags.RUN_FIRST, None, (GObject.TYPE_PYOBJECT,)),
+        "station-removed": (GObject.SignalFlags.RUN_FIRST, None, (GObject.TYPE_PYOBJECT,)),
+        "station-renamed": (GObject.SignalFlags.RUN_FIRST, None, (GObject.TYPE_PYOBJECT,)),
         "stations-dlg-ready": (GObject.SignalFlags.RUN_FIRST, None, (GObject.TYPE_BOOLEAN,)),
         "songs-added": (GObject.SignalFlags.RUN_FIRST, None, (GObject.TYPE_INT,)),
         "player-ready": (GObject.SignalFlags.RUN_FIRST, None, (GObject.TYPE_BOOLEAN,)),
@@ -251,6 +301,7 @@ class PithosWindow(Gtk.ApplicationWindow):
 
     def __init__(self, app, test_mode):
         super().__init__(application=app)
+        self.startup = StartupTimeline()
         self.init_template()
 
         self.settings = Gio.Settings.new('io.github.Pithos')
@@ -258,41 +309,133 @@ class PithosWindow(Gtk.ApplicationWindow):
         self.settings.connect('changed::proxy', self.set_proxy)
         self.settings.connect('changed::control-proxy', self.set_proxy)
         self.settings.connect('changed::control-proxy-pac', self.set_proxy)
+        self.settings.connect('changed::playlist-lookahead', self.update_lookahead)
+        self.settings.connect('changed::history-length', self.trim_history)
+        self.settings.connect('changed::gapless-playback', self.prepare_gapless)
+        self.settings.connect('changed::history-max-length', self.trim_history)
 
         self.prefs_dlg = PreferencesPithosDialog.PreferencesPithosDialog(transient_for=self)
         self.prefs_dlg.connect_after('response', self.on_prefs_response)
         self.prefs_dlg.connect('login-changed', self.pandora_reconnect)
 
+        self.test_mode = test_mode
+        self.worker = GObjectWorker()
+        self.pandora = make_pandora(test_mode)
+        self.pandora.set_cache_dir(os.path.join(GLib.get_user_cache_dir(), 'pithos'))
+        self.art_cache = album_art.ArtCache(os.path.join(GLib.get_user_cache_dir(), 'pithos', 'album-art'))
+        self.pixbuf_cache = album_art.PixbufCache()
+        self.prefetcher = Prefetcher(os.path.join(GLib.get_user_cache_dir(), 'pithos', 'audio'))
+        # Test mode must not leave fake track tokens behind for real sessions.
+        feedback_path = None if test_mode else os.path.join(GLib.get_user_data_dir(), 'pithos', 'feedback-queue.json')
+        self.feedback = FeedbackQueue(self.pandora, feedback_path)
+        self.set_proxy(reconnect=False)
+        self.set_audio_quality()
+        # Logging in runs alongside setting up GStreamer, the UI and the plugins.
+        self.start_login()
+
         self.init_core()
+        self.startup.mark('gstreamer ready')
         self.init_ui()
         self.init_actions(app)
 
         self.plugins = {}
         load_plugins(self)
+        self.startup.mark('window ready')
+        self.show_cached_stations()
 
-        self.pandora = make_pandora(test_mode)
-        self.set_proxy(reconnect=False)
-        self.set_audio_quality()
-        SecretService.unlock_keyring(self.on_keyring_unlocked)
-
-    def on_keyring_unlocked(self, error):
-        if error:
-            logging.error('You need to install a service such as gnome-keyring. Error: {}'.format(error))
-            self.fatal_error_dialog(
-                error.message,
-                _('You need to install a service such as gnome-keyring.'),
-            )
+    def show_cached_stations(self):
+        """Shows the stations we had last time until the real list arrives"""
+        email = self.settings['email']
+        if self.test_mode or not email:
+            return
+        self.pandora.set_station_cache(email)
+        if self.pandora.load_cached_stations():
+            self.startup.mark('cached stations')
+            self.process_stations(cached=True)
+
+    def start_login(self):
+        """Logs in with the independent steps running concurrently
+
+        A saved session is resumed without logging in at all. Otherwise
+        auth.partnerLogin and the Blowfish setup, which don't need the password,
+        run in a worker while the password is looked up. The user login waits for both.
+        """
+        def on_keyring_unlocked(error):
+            self.startup.mark('keyring unlocked')
+            if error:
+                logging.error('You need to install a service such as gnome-keyring. Error: {}'.format(error))
+                self.fatal_error_dialog(
+                    error.message,
+                    _('You need to install a service such as gnome-keyring.'),
+                )
+                return
 
-        else:
             maybe_migrate_settings()
-            self.pandora_connect()
+            email = self.settings['email']
+            if not email:
+                self.show_preferences()
+            elif self.test_mode:
+                # The fake session must not touch the user's real one.
+                self.login_with_password(email)
+            else:
+                SecretService.get_session(email, on_session)
+
+        def on_session(session):
+            self.startup.mark('saved session')
+            email = self.settings['email']
+            if session and self.pandora.restore_session(session, self._get_client()):
+                # If the tokens turn out to have expired the first call raises
+                # PandoraAuthTokenInvalid and worker_run logs in.
+                self._pandora_connect_real("Logging in...", None, email, None, session_restored=True)
+            else:
+                self.login_with_password(email)
+
+        SecretService.unlock_keyring(on_keyring_unlocked)
+
+
+    def login_with_password(self, email):
+        """Logs in with the partner login running while the password is looked up"""
+        client = self._get_client()
+        pending = {'partner login', 'password'}
+        results = {}
+        # Logged in on a copy so an error can't leave a half set up session behind.
+        partner = copy.copy(self.pandora)
+
+        def join(step, result):
+            self.startup.mark(step)
+            results[step] = result
+            pending.discard(step)
+            if pending:
+                return
+
+            password = results['password']
+            if not password:
+                self.show_preferences()
+            elif results['partner login'] is not None or client != self._get_client():
+                # Errors, and settings changed meanwhile, get the usual handling of a full login.
+                self._pandora_connect_real("Logging in...", None, email, password)
+            else:
+                self.pandora._swap_session(partner)
+                self._pandora_connect_real("Logging in...", None, email, password,
+                                           partner_logged_in=True)
 
+        def on_partner_login_failed(e):
+            logging.info('Early partner login failed: %s', getattr(e, 'message', e))
+            join('partner login', e)
+
+        self.worker_run(partner.partner_login, (client,), lambda *ignore: join('partner login', None),
+                        context=None, errorback=on_partner_login_failed)
+        SecretService.get_account_password(email, lambda password: join('password', password))
 
     def init_core(self):
         #                                Song object            display text  icon  album art
         self.songs_model = Gtk.ListStore(GObject.TYPE_PYOBJECT, str,          str,  GdkPixbuf.Pixbuf)
         #                                   Station object         station name  index
         self.stations_model = Gtk.ListStore(GObject.TYPE_PYOBJECT, str,          int)
+        # Work for the songs in songs_model, cancelled when they're thrown away
+        self.playlist_tasks = CancelGroup()
+        # Compacted songs whose art is being loaded again
+        self.art_reloading = set()
 
         Gst.init(None)
         self._query_duration = Gst.Query.new_duration(Gst.Format.TIME)
@@ -339,6 +482,13 @@ class PithosWindow(Gtk.ApplicationWindow):
         bus.connect("message::element", self.on_gst_element)
         self.player.connect("notify::volume", self.on_gst_volume)
         self.player.connect("notify::source", self.on_gst_source)
+        self.player.connect("about-to-finish", self.on_gst_about_to_finish)
+        # (song, uri) to queue when the current song is about to finish, read from a streaming thread
+        self.gapless_next = None
+        # The song queued by about-to-finish, it becomes current on stream-start
+        self.gapless_queued = None
+        # trackToken of the next song being prefetched
+        self.prefetched_next = None
 
         self.stations_dlg = None
 
@@ -352,6 +502,7 @@ class PithosWindow(Gtk.ApplicationWindow):
         self.filter_state = None
         self.auto_retrying_auth = False
         self.have_stations = False
+        self.showing_cached_stations = False
         self.playcount = 0
         self.gstreamer_errorcount_1 = 0
         self.gstreamer_errorcount_2 = 0
@@ -360,18 +511,21 @@ class PithosWindow(Gtk.ApplicationWindow):
         self.start_new_playlist = False
         self.buffering_timer_id = 0
         self.ui_loop_timer_id = 0
+        # The ui loop only runs while playing and the window can be seen.
+        self.ui_loop_wanted = False
+        self.ui_mapped = False
+        self.ui_iconified = False
         self.playlist_update_timer_id = 0
+        self.lookahead_timer_id = 0
+        # Songs update_lookahead counted when it last asked for a playlist
+        self.lookahead_fetch_queued = None
+        self.feedback_flush_timer_id = 0
+        self.feedback_retry_delay = FEEDBACK_FLUSH_DELAY
+        self.session_check_timer_id = 0
+        # Set while a background login runs, to tell it from one a reconnect made stale
+        self.reauthenticating = None
         display = self.props.screen.get_display()
         self.not_in_x = not type(display).__name__.endswith('X11Display')
-        self.worker = GObjectWorker()
-
-        try:
-            self.tempdir = tempfile.TemporaryDirectory(prefix='pithos-',
-                                                       dir=GLib.get_user_cache_dir())
-            logging.info("Created temporary directory %s" %self.tempdir.name)
-        except IOError as e:
-            self.tempdir = None
-            logging.warning('Failed to create a temporary directory')
 
     @property
     def playing(self):
@@ -388,6 +542,7 @@ class PithosWindow(Gtk.ApplicationWindow):
         self.settings.bind('volume', self.volume, 'value', Gio.SettingsBindFlags.DEFAULT)
 
         self.songs_treeview.set_model(self.songs_model)
+        self.songs_treeview.get_vadjustment().connect('value-changed', self.reload_visible_art)
 
         title_col   = Gtk.TreeViewColumn()
 
@@ -404,10 +559,17 @@ class PithosWindow(Gtk.ApplicationWindow):
 
         self.songs_treeview.append_column(title_col)
 
-        self.get_style_context().connect('changed', lambda sc: render_cover_art.update_icons(sc))
+        def update_icons(*ignore):
+            render_cover_art.update_icons(self.get_style_context(), self.get_scale_factor())
+        self.get_style_context().connect('changed', update_icons)
+        self.connect('notify::scale-factor', update_icons)
 
         self.songs_treeview.connect('button_press_event', self.on_treeview_button_press_event)
 
+        self.connect('map-event', self.on_map_event)
+        self.connect('unmap-event', self.on_unmap_event)
+        self.connect('window-state-event', self.on_window_state_event)
+
         self.stations_popover = StationsPopover()
         self.stations_popover.set_relative_to(self.stations_button)
         self.stations_popover.set_model(self.stations_model)
@@ -470,14 +632,23 @@ class PithosWindow(Gtk.ApplicationWindow):
         app.add_accelerator('<Primary>d', 'win.bookmark', None)
         action.connect('activate', self.bookmark_song)
 
-    def worker_run(self, fn, args=(), callback=None, message=None, context='net', errorback=None, user_data=None):
+    def worker_run(self, fn, args=(), callback=None, message=None, context='net', errorback=None, user_data=None,
+                   priority=PRIORITY_INTERACTIVE, cancel_token=None, kind=None):
         if context and message:
             self.statusbar.push(self.statusbar.get_context_id(context), message)
 
         if isinstance(fn,str):
             fn = getattr(self.pandora, fn)
 
+        def cancelled():
+            self.statusbar.pop(self.statusbar.get_context_id(context))
+
+        if cancel_token is not None and context and message:
+            cancel_token.add_callback(cancelled)
+
         def cb(v):
+            if cancel_token is not None:
+                cancel_token.remove_callback(cancelled)
             if context: self.statusbar.pop(self.statusbar.get_context_id(context))
             if callback:
                 if user_data:
@@ -486,13 +657,16 @@ class PithosWindow(Gtk.ApplicationWindow):
                     callback(v)
 
         def eb(e):
+            if cancel_token is not None:
+                cancel_token.remove_callback(cancelled)
             if context and message:
                 self.statusbar.pop(self.statusbar.get_context_id(context))
 
             def retry_cb():
                 self.auto_retrying_auth = False
                 if fn is not self.pandora.connect:
-                    self.worker_run(fn, args, callback, message, context)
+                    self.worker_run(fn, args, callback, message, context, priority=priority,
+                                    cancel_token=cancel_token, kind=kind)
 
             if isinstance(e, PandoraAuthTokenInvalid) and not self.auto_retrying_auth:
                 self.auto_retrying_auth = True
@@ -507,7 +681,7 @@ class PithosWindow(Gtk.ApplicationWindow):
 
         err = errorback or eb
 
-        self.worker.send(fn, args, cb, err)
+        self.worker.send(fn, args, cb, err, priority=priority, cancel_token=cancel_token, kind=kind)
 
     def get_proxy(self):
         """ Get HTTP proxy, first trying preferences then system proxy """
@@ -605,7 +779,7 @@ class PithosWindow(Gtk.ApplicationWindow):
         else:
             SecretService.get_account_password(email, cb)
 
-    def _pandora_connect_real(self, message, callback, email, password):
+    def _get_client(self):
         if self.settings['pandora-one']:
             client = client_keys[default_one_client_id]
         else:
@@ -620,31 +794,106 @@ class PithosWindow(Gtk.ApplicationWindow):
                 client = json.loads(force_client)
             except json.JSONDecodeError:
                 logging.error("Could not parse force_client json")
+        return client
 
-        args = (
-            client,
-            email,
-            password,
-        )
+    def _pandora_connect_real(self, message, callback, email, password, partner_logged_in=False,
+                              session_restored=False):
+        if partner_logged_in:
+            connect, args = 'user_login', (email, password)
+        else:
+            connect, args = 'connect', (self._get_client(), email, password)
+        if not self.test_mode:
+            self.pandora.set_station_cache(email)
 
         def on_got_stations(*ignore):
+            self.startup.mark('stations')
             self.process_stations(self)
+            # Send anything queued while we were offline or from a previous session.
+            self.flush_feedback()
             if callback:
                 callback()
 
         def pandora_ready(*ignore):
             logging.info("Pandora connected")
+            self.startup.mark('logged in')
+            self.start_session_checks()
+            if session_restored:
+                # A saved session was made with the client the current settings pick.
+                self.worker_run('get_stations', (), on_got_stations, 'Getting stations...', 'login')
+                return
+            self.save_session()
             if self.settings['pandora-one'] != self.pandora.isSubscriber:
                 self.settings['pandora-one'] = self.pandora.isSubscriber
                 self._pandora_connect_real(message, callback, email, password)
             else:
                 self.worker_run('get_stations', (), on_got_stations, 'Getting stations...', 'login')
 
-        self.worker_run('connect', args, pandora_ready, message, 'login')
+        if session_restored:
+            pandora_ready()
+        else:
+            self.worker_run(connect, args, pandora_ready, message, 'login')
+
+    def save_session(self):
+        if self.test_mode:
+            return
+        session = self.pandora.export_session()
+        if session:
+            SecretService.set_session(self.settings['email'], session)
+
+    def start_session_checks(self):
+        if not self.session_check_timer_id:
+            self.session_check_timer_id = GLib.timeout_add_seconds(SESSION_CHECK_INTERVAL, self.check_session)
+
+    def check_session(self):
+        """Logs in again in the background once the session is getting old
+
+        The new session replaces the old one in one go, so foreground calls
+        rarely hit an invalid auth token and have to wait on a reconnect.
+        """
+        age = self.pandora.session_age
+        if age is None or age < SESSION_REFRESH_AGE or self.reauthenticating:
+            return True
+
+        email = self.settings['email']
+        if not email:
+            return True
+        client = self._get_client()
+        # A login started after this one, e.g. for another account, wins.
+        generation = self.pandora.session_generation
+        attempt = object()
+
+        def finished():
+            if self.reauthenticating is attempt:
+                self.reauthenticating = None
+
+        def on_password(password):
+            if not password or self.reauthenticating is not attempt:
+                finished()
+                return
+            args = (client, email, password, generation)
+            self.worker_run(self.pandora.reauthenticate, args, reauthenticated, context=None,
+                            errorback=reauthenticate_failed, priority=PRIORITY_BACKGROUND)
+
+        def reauthenticated(swapped):
+            finished()
+            if swapped and email == self.settings['email'] and client == self._get_client():
+                self.save_session()
+
+        def reauthenticate_failed(e):
+            # The old session is untouched, we try again at the next check.
+            finished()
+            logging.warning('Background login failed: %s', getattr(e, 'message', e))
+
+        logging.info('Session is %i minutes old, logging in again', age // 60)
+        self.reauthenticating = attempt
+        SecretService.get_account_password(email, on_password)
+        return True
 
     def pandora_reconnect(self, prefs_dialog, email_password):
         ''' Stop everything and reconnect '''
         email, password = email_password
+        # The login below replaces any background one, whose result is discarded.
+        self.reauthenticating = None
         self.stop()
         self.waiting_for_playlist = False
         self.current_song_index = None
@@ -653,6 +902,12 @@ class PithosWindow(Gtk.ApplicationWindow):
         self.current_station_id = None
         self.have_stations = False
         self.playcount = 0
+        self.playlist_tasks.cancel()
+        self.art_reloading.clear()
+        self.prefetcher.release_all()
+        # Queued feedback is sent once the new session has its stations.
+        self.cancel_feedback_flush()
+        self.feedback_retry_delay = FEEDBACK_FLUSH_DELAY
         self.songs_model.clear()
         self._pandora_connect_real("Logging in...", None, email, password)
 
@@ -679,31 +934,68 @@ class PithosWindow(Gtk.ApplicationWindow):
 
             self.worker_run(get_filter_and_pin_protected_state, (), sync_checkbox)
 
-    def process_stations(self, *ignore):
-        self.stations_model.clear()
-        self.stations_popover.clear()
-        self.current_station = None
-        selected = None
+    def process_stations(self, *ignore, cached=False):
+        """Brings the station list in line with pandora.stations
+
+        Only the rows that differ are touched so refreshing an unchanged list
+        costs no redraws and the current station keeps playing.
+        """
         # Make sure that the Thumprint Radio Station is always 2nd.
         for i, s in enumerate(self.pandora.stations):
             if s.isThumbprint:
                 self.pandora.stations.insert(1, self.pandora.stations.pop(i))
                 break
-        for i, s in enumerate(self.pandora.stations):
-            if s.isQuickMix and s.isCreator:
-                self.stations_model.append((s, "QuickMix", i))
+
+        first_population = not len(self.stations_model)
+        stations = {s.id: (i, s) for i, s in enumerate(self.pandora.stations)}
+        rows = {}
+        for row in list(self.stations_model):
+            station = row[0]
+            if station.id in stations:
+                rows[station.id] = row
             else:
-                self.stations_model.append((s, s.name, i))
-            if s.id == self.current_station_id:
-                logging.info("Restoring saved station: id = %s"%(s.id))
-                selected = s
-        if not selected and len(self.stations_model):
-            selected=self.stations_model[0][0]
+                self.stations_model.remove(row.iter)
+                self.stations_popover.remove_station(station)
+                self.emit('station-removed', station)
+
+        for station_id, (i, s) in stations.items():
+            name = "QuickMix" if s.isQuickMix and s.isCreator else s.name
+            row = rows.get(station_id)
+            if row is None:
+                self.stations_model.append((s, name, i))
+                if not first_population:
+                    self.emit('station-added', s)
+                continue
+            if row[0] is not s:
+                row[0] = s
+            if row[1] != name:
+                row[1] = name
+                if s is self.current_station:
+                    self.stations_label.set_text(s.name)
+                self.emit('station-renamed', (station_id, name))
+            if row[2] != i:
+                row[2] = i
+
+        was_cached = self.showing_cached_stations
+        self.showing_cached_stations = cached
+        selected = self.pandora.get_station_by_id(self.current_station_id)
         if selected:
-            self.station_changed(selected, reconnecting = self.have_stations)
-            self.have_stations = True
-            self.emit('stations-processed', self.pandora.stations)
-        else:
+            logging.info("Restoring saved station: id = %s"%(selected.id))
+        elif self.pandora.stations:
+            selected = self.pandora.stations[0]
+        if selected:
+            if selected is self.current_station:
+                if was_cached and not cached:
+                    # The cached station became a real one, it can play now.
+                    self.get_playlist(start = True)
+            else:
+                self.station_changed(selected, reconnecting = self.have_stations)
+            # Cached stations are replaced once we're logged in so the real ones
+            # still need to start a playlist.
+            self.have_stations = self.have_stations or not cached
+            if first_population:
+                self.emit('stations-processed', self.pandora.stations)
+        elif not cached:
             # User has no stations, open dialog
             self.show_stations()
 
@@ -712,14 +1004,24 @@ class PithosWindow(Gtk.ApplicationWindow):
         if self.current_song_index is not None:
             return self.songs_model[self.current_song_index][0]
 
+    @staticmethod
+    def song_is_playable(song):
+        return not (song.tired or song.rating == RATE_BAN)
+
     def start_song(self, song_index):
-        songs_remaining = len(self.songs_model) - song_index
-        if songs_remaining <= 0:
+        # Skip anything that can't be played before touching the current song.
+        while song_index < len(self.songs_model):
+            song = self.songs_model[song_index][0]
+            if not song.is_still_valid():
+                song.message = 'Song expired'
+                self.update_song_row(song)
+            elif self.song_is_playable(song):
+                break
+            song_index += 1
+
+        if song_index >= len(self.songs_model):
             # We don't have this song yet. Get a new playlist.
             return self.get_playlist(start = True)
-        elif songs_remaining == 1:
-            # Preload next playlist so there's no delay
-            self.get_playlist()
 
         prev = self.current_song
 
@@ -728,14 +1030,9 @@ class PithosWindow(Gtk.ApplicationWindow):
 
         if prev:
             self.update_song_row(prev)
-
-        if not self.current_song.is_still_valid():
-            self.current_song.message = 'Song expired'
-            self.update_song_row()
-            return self.next_song()
-
-        if self.current_song.tired or self.current_song.rating == RATE_BAN:
-            return self.next_song()
+        # This may renumber the rows.
+        self.trim_history()
+        song_index = self.current_song_index
 
         logging.info("Starting song: index = %i"%(song_index))
         song = self.current_song
@@ -746,19 +1043,190 @@ class PithosWindow(Gtk.ApplicationWindow):
         os.environ['PULSE_PROP_media.filename'] = audioUrl
         self.player.set_property('buffer-size', int(song.bitrate) * 375)
         self.player.set_property('connection-speed', int(song.bitrate))
-        self.player.set_property("uri", audioUrl)
+        self.player.set_property("uri", self.playback_uri(song))
         self._set_player_state(PseudoGst.BUFFERING)
+        self.song_started(song)
+
+    def song_started(self, song):
+        """Bookkeeping for the current song once it's playing, or about to"""
         self.playcount += 1
 
         self.current_song.start_time = time.time()
-        self.songs_treeview.scroll_to_cell(song_index, use_align=True, row_align = 1.0)
-        self.songs_treeview.set_cursor(song_index, None, 0)
+        self.songs_treeview.scroll_to_cell(song.index, use_align=True, row_align = 1.0)
+        self.songs_treeview.set_cursor(song.index, None, 0)
         self.set_title("%s by %s - Pithos" % (song.title, song.artist))
 
         self.update_song_row()
 
         self.emit('song-changed', song)
         self.emit('metadata-changed', song)
+        self.update_lookahead()
+        self.prepare_gapless()
+        self.prefetch_next()
+
+    def next_playable_song(self):
+        """The song start_song would play after the current one, if we have it"""
+        if self.current_song_index is None:
+            return None
+        for index in range(self.current_song_index + 1, len(self.songs_model)):
+            song = self.songs_model[index][0]
+            if song.is_still_valid() and self.song_is_playable(song):
+                return song
+        return None
+
+    def playback_uri(self, song):
+        """The uri to play song from, its prefetched copy if prefetch-audio is on"""
+        if not self.settings['prefetch-audio']:
+            return song.audioUrl
+        current = self.current_song
+        after_key = current.trackToken if current is not None and current is not song else None
+        return self.prefetcher.prefetch(song.trackToken, song.audioUrl, after_key)
+
+    def prefetch_next(self):
+        """Downloads the next song once the current one is done so it's ready when we get there"""
+        song = self.next_playable_song() if self.settings['prefetch-audio'] else None
+        key = song.trackToken if song is not None else None
+        current = self.current_song
+        if (self.prefetched_next not in (None, key)
+                and (current is None or current.trackToken != self.prefetched_next)):
+            # The next song changed, e.g. it was banned, its download would only push out others.
+            self.prefetcher.release(self.prefetched_next)
+        self.prefetched_next = key
+        if song is not None:
+            self.playback_uri(song)
+
+    def prepare_gapless(self, *ignore):
+        """Picks the song about-to-finish queues after the current one"""
+        self.gapless_next = None
+        if not self.settings['gapless-playback']:
+            return
+        song = self.next_playable_song()
+        if song is not None:
+            self.gapless_next = song, self.playback_uri(song)
+
+    def on_gst_about_to_finish(self, player):
+        # This runs in a streaming thread, only the uri may be set here.
+        # The rest is done on stream-start once the new song is actually playing.
+        gapless_next = self.gapless_next
+        if gapless_next is None:
+            return
+        song, uri = gapless_next
+        # It may have been rated or expired since it was picked.
+        if not self.song_is_playable(song) or not song.is_still_valid():
+            return
+        logging.info("Queueing next song gaplessly: %s" % song.trackToken)
+        self.gapless_queued = song
+        player.set_property("uri", uri)
+
+    def finish_gapless_transition(self):
+        """Makes the song queued by about-to-finish current now that its stream has started"""
+        song, self.gapless_queued = self.gapless_queued, None
+        prev = self.current_song
+        if self.song_row(song) is None or song is prev:
+            return
+        if prev:
+            prev.finished = True
+            # It played to the end.
+            prev.position = prev.duration or prev.trackLength * Gst.SECOND
+            self.emit("song-ended", prev)
+            self.update_song_row(prev)
+            self.prefetcher.release(prev.trackToken)
+        self.current_song_index = song.index
+        # This may renumber the rows.
+        self.trim_history()
+
+        logging.info("Started song gaplessly: index = %i"%(song.index))
+        os.environ['PULSE_PROP_media.title'] = song.title
+        os.environ['PULSE_PROP_media.artist'] = song.artist
+        os.environ['PULSE_PROP_media.name'] = '{}: {}'.format(song.artist, song.title)
+        os.environ['PULSE_PROP_media.filename'] = song.audioUrl
+        self.player.set_property('buffer-size', int(song.bitrate) * 375)
+        self.player.set_property('connection-speed', int(song.bitrate))
+        self.song_started(song)
+
+    def cancel_lookahead(self):
+        if self.lookahead_timer_id:
+            GLib.source_remove(self.lookahead_timer_id)
+            self.lookahead_timer_id = 0
+
+    def update_lookahead(self, *ignore):
+        """Keeps playlist-lookahead songs that will still be valid when we get to them queued
+
+        If enough are queued this checks again when the first of them would expire.
+        """
+        self.cancel_lookahead()
+        if self.current_song_index is None or self.current_station is None:
+            return False
+        if self.waiting_for_playlist:
+            # We're called again once it arrives.
+            return False
+        if not self.playing:
+            # A timer would only keep fetching playlists nobody hears, play() calls us again.
+            return False
+
+        if self.remove_expired_songs():
+            self.prepare_gapless()
+            self.prefetch_next()
+
+        song = self.current_song
+        if song.start_time and not song.finished:
+            # The ui loop that keeps this current is paused while the window is hidden.
+            position = self.query_position()
+            if position is not None:
+                song.position = position
+        start_time = time.time() + max(song.get_duration_sec() - song.get_position_sec(), 0)
+        queued = 0
+        next_check = None
+        for index in range(self.current_song_index + 1, len(self.songs_model)):
+            song = self.songs_model[index][0]
+            if not self.song_is_playable(song):
+                continue
+            slack = song.latest_start_time() - start_time
+            if slack <= 0:
+                # It will have expired by the time we get to it, remove it once it has.
+                expires = song.latest_start_time() - time.time()
+                next_check = expires if next_check is None else min(next_check, expires)
+                continue
+            queued += 1
+            next_check = slack if next_check is None else min(next_check, slack)
+            start_time += song.get_duration_sec()
+
+        fetch_queued, self.lookahead_fetch_queued = self.lookahead_fetch_queued, None
+        if queued < self.settings['playlist-lookahead']:
+            if fetch_queued is not None and queued <= fetch_queued:
+                # With long songs the new ones can't be reached in time either,
+                # asking again would only pile up rows. The next song tries again.
+                logging.info('%i songs queued, the last playlist added none we can reach', queued)
+            else:
+                logging.info('%i songs queued, getting more', queued)
+                self.lookahead_fetch_queued = queued
+                self.get_playlist()
+                return False
+        if next_check is not None:
+            self.lookahead_timer_id = GLib.timeout_add_seconds(max(int(next_check), 0) + 1, self.update_lookahead)
+        return False
+
+    def remove_expired_songs(self):
+        """Removes queued songs that expired before we got to them
+
+        :returns: True if any were removed
+        """
+        removed = 0
+        index = len(self.songs_model) - 1
+        while index > self.current_song_index:
+            song = self.songs_model[index][0]
+            # One queued in the player is already on its way.
+            if not song.is_still_valid() and song is not self.gapless_queued:
+                logging.info("Removing expired song %i" % index)
+                song.index = -1
+                del self.songs_model[index]
+                self.prefetcher.release(song.trackToken)
+                removed += 1
+            index -= 1
+        if removed:
+            for index in range(self.current_song_index + 1, len(self.songs_model)):
+                self.songs_model[index][0].index = index
+        return removed > 0
 
     @GtkTemplate.Callback
     def next_song(self, *ignore):
@@ -776,6 +1244,7 @@ class PithosWindow(Gtk.ApplicationWindow):
                 return False
             self._current_state = target
             if self._current_state is PseudoGst.PLAYING:
+                self.startup.finish('first audio')
                 self.create_ui_loop()
             else:
                 self.destroy_ui_loop()
@@ -801,6 +1270,8 @@ class PithosWindow(Gtk.ApplicationWindow):
         if self._set_player_state(PseudoGst.PLAYING, change_gst_state=change_gst_state):
             self.playpause_image.set_from_icon_name('media-playback-pause-symbolic', Gtk.IconSize.SMALL_TOOLBAR)
             self.emit('play-state-changed', True)
+            # Songs may have expired while we were paused.
+            self.update_lookahead()
         return True
 
     def user_pause(self, *ignore):
@@ -811,14 +1282,19 @@ class PithosWindow(Gtk.ApplicationWindow):
         if self._set_player_state(PseudoGst.PAUSED):
             self.playpause_image.set_from_icon_name('media-playback-start-symbolic', Gtk.IconSize.SMALL_TOOLBAR)
             self.emit('play-state-changed', False)
+            self.cancel_lookahead()
 
 
     def stop(self):
+        self.gapless_next = self.gapless_queued = None
         prev = self.current_song
         if prev and prev.start_time:
             prev.finished = True
             prev.position = self.query_position()
             self.emit("song-ended", prev)
+        if prev:
+            # Prefetched audio is only kept while it's played.
+            self.prefetcher.release(prev.trackToken)
 
         if self._set_player_state(PseudoGst.STOPPED, change_gst_state=True):
             # We need to reset the icon at song changes since our default
@@ -862,36 +1338,18 @@ class PithosWindow(Gtk.ApplicationWindow):
             self.emit('songs-added', song_count)
             return False
 
-        def get_album_art(url, tmpdir, *extra):
-            try:
-                with urllib.request.urlopen(url) as f:
-                    image = f.read()
-            except urllib.error.HTTPError:
-                logging.warning('Invalid image url received')
-                return (None, None,) + extra
-
-            file_url = None
-            if tmpdir:
-                try:
-                    with tempfile.NamedTemporaryFile(prefix='art-', dir=tmpdir.name, delete=False) as f:
-                        f.write(image)
-                        file_url = urllib.parse.urljoin('file://', urllib.parse.quote(f.name))
-                except IOError:
-                    logging.warning("Failed to write art tempfile")
-
-            with contextlib.closing(GdkPixbuf.PixbufLoader()) as loader:
-                loader.set_size(ALBUM_ART_SIZE, ALBUM_ART_SIZE)
-                loader.write(image)
-            return (loader.get_pixbuf(), file_url,) + extra
+        def get_album_art(url, size, cancel_token, *extra):
+            return self.fetch_album_art(url, size, cancel_token) + extra
 
         def art_callback(t):
             nonlocal songs_left_to_process
-            pixbuf, file_url, song, index = t
+            pixbuf, file_url, song = t
             songs_left_to_process -= 1
-            if index<len(self.songs_model) and self.songs_model[index][0] is song: # in case the playlist has been reset
+            row = self.song_row(song)
+            if row is not None: # in case the playlist has been reset
                 logging.info("Downloaded album art for %i"%song.index)
                 song.art_pixbuf = pixbuf
-                self.songs_model[index][3]=pixbuf
+                row[3] = pixbuf
                 self.update_song_row(song)
                 if file_url:
                     song.artUrl = file_url
@@ -906,18 +1364,38 @@ class PithosWindow(Gtk.ApplicationWindow):
                     GLib.source_remove(self.playlist_update_timer_id)
                     emit_songs_added(song_count)
 
+        def title_callback(title, song):
+            if song.title == title:
+                return
+            song.title = title
+            if self.song_row(song) is not None:
+                self.update_song_row(song)
+                if song is self.current_song:
+                    self.set_title("%s by %s - Pithos" % (song.title, song.artist))
+                self.emit('metadata-changed', song)
+
         def callback(l):
             nonlocal songs_left_to_process
             nonlocal song_count
+            self.startup.mark('playlist')
             songs_left_to_process = song_count = len(l)
             start_index = len(self.songs_model)
+            art_size = self.album_art_size()
             for i in l:
                 i.index = len(self.songs_model)
+                # What update_song_row last put in the row
+                i.description_key = i.description_markup = i.row_markup = i.row_icon = None
                 self.songs_model.append((i, '', None, None))
                 self.update_song_row(i)
+                # Titles that need a song explorer lookup show songName until it's done.
+                if i.needs_title_lookup:
+                    self.worker_run(i.lookup_title, (cancel_token,), title_callback, context=None, user_data=i,
+                                    priority=PRIORITY_BACKGROUND, cancel_token=cancel_token, kind='song-title')
                 i.art_pixbuf = None
                 if i.artRadio:
-                    self.worker_run(get_album_art, (i.artRadio, self.tempdir, i, i.index), art_callback)
+                    self.worker_run(get_album_art, (i.artRadio, art_size, cancel_token, i),
+                                    art_callback, priority=PRIORITY_BACKGROUND, cancel_token=cancel_token,
+                                    kind='album-art')
                 else:
                     songs_left_to_process -= 1
             # Give Pandora about 1 secs per song to return the playlist's cover art
@@ -933,9 +1411,15 @@ class PithosWindow(Gtk.ApplicationWindow):
             self.playcount = 0
             self.waiting_for_playlist = False
             self.start_new_playlist = False
+            if l:
+                self.update_lookahead()
+                self.prepare_gapless()
+                self.prefetch_next()
 
         self.waiting_for_playlist = True
-        self.worker_run(self.current_station.get_playlist, (), callback, "Getting songs...")
+        cancel_token = self.playlist_tasks.token
+        self.worker_run(self.current_station.get_playlist, (), callback, "Getting songs...",
+                        priority=PRIORITY_PLAYBACK, cancel_token=cancel_token)
 
     def error_dialog(self, message, retry_cb, submsg=None):
         dialog = self.error_dialog_real
@@ -979,15 +1463,23 @@ class PithosWindow(Gtk.ApplicationWindow):
     def station_changed(self, station, reconnecting=False):
         if station is self.current_station: return
         self.waiting_for_playlist = False
+        self.cancel_lookahead()
+        self.lookahead_fetch_queued = None
         if not reconnecting:
             self.stop()
+            # Stop fetching the old station's playlist, art and audio.
+            self.playlist_tasks.cancel()
+            self.prefetcher.release_all()
+            self.art_reloading.clear()
             self.current_song_index = None
             self.songs_model.clear()
         logging.info("Selecting station %s; total = %i" % (station.id, len(self.stations_model)))
         self.current_station_id = station.id
         self.current_station = station
         self.settings.set_string('last-station-id', self.current_station_id)
-        if not reconnecting:
+        # A station from the cached list can't play, the playlist is
+        # started once the real list has replaced it.
+        if not reconnecting and not self.showing_cached_stations:
             self.get_playlist(start = True)
         self.stations_label.set_text(station.name)
         self.stations_popover.select_station(station)
@@ -999,9 +1491,6 @@ class PithosWindow(Gtk.ApplicationWindow):
             if existing_station[0].id == station.id:
                 self.station_already_exists(existing_station[0], description, music_type, self)
                 return
-        # We shouldn't actually add the station to the pandora stations list
-        # until we know it's not a duplicate.
-        self.pandora.stations.append(station)
         self.stations_model.insert_with_valuesv(0, (0, 1, 2), (station, station.name, 0))
         self.emit('station-added', station)
         self.station_changed(station)
@@ -1066,6 +1555,8 @@ class PithosWindow(Gtk.ApplicationWindow):
         # If so self.current_song will be None.
         if self.current_song is None:
             return
+        if self.gapless_queued is not None:
+            self.finish_gapless_transition()
         # Fallback to using song.trackLength which is in seconds and converted to nanoseconds
         self.current_song.duration = self.query_duration() or self.current_song.trackLength * Gst.SECOND
         self.current_song.duration_message = self.format_time(self.current_song.duration)
@@ -1183,6 +1674,9 @@ class PithosWindow(Gtk.ApplicationWindow):
     def on_gst_source(self, player, params):
         """ Setup httpsoupsrc to match Pithos proxy settings """
         soup = player.props.source.props
+        if self.prefetcher.is_local(getattr(soup, 'location', None) or ''):
+            # Prefetched audio is served locally, it must not go through the proxy.
+            return
         proxy = self.get_proxy()
         if proxy and hasattr(soup, 'proxy'):
             scheme, user, password, hostport = parse_proxy(proxy)
@@ -1190,10 +1684,23 @@ class PithosWindow(Gtk.ApplicationWindow):
             soup.proxy_id = user
             soup.proxy_pw = password
 
+    def song_description(self, song):
+        """The markup for song's title, artist and album, built again only when they change"""
+        key = song.title, song.artist, song.album, song.is_ad
+        if song.description_key != key:
+            if song.is_ad:
+                description = "<b><big>Commercial Advertisement</big></b>\n<b>Pandora</b>"
+            else:
+                title = html.escape(song.title)
+                artist = html.escape(song.artist)
+                album = html.escape(song.album)
+                description = "<b><big>%s</big></b>\nby <b>%s</b>\n<small>from <i>%s</i></small>" % (
+                    title, artist, album)
+            song.description_key = key
+            song.description_markup = description
+        return song.description_markup
+
     def song_text(self, song):
-        title = html.escape(song.title)
-        artist = html.escape(song.artist)
-        album = html.escape(song.album)
         msg = []
         if song is self.current_song:
             song.position = self.query_position()
@@ -1213,12 +1720,7 @@ class PithosWindow(Gtk.ApplicationWindow):
         if not msg:
             msg = " "
 
-        if song.is_ad:
-            description = "<b><big>Commercial Advertisement</big></b>\n<b>Pandora</b>"
-        else:
-            description = "<b><big>%s</big></b>\nby <b>%s</b>\n<small>from <i>%s</i></small>" % (title, artist, album)
-
-        return "%s\n<small>%s</small>" % (description, msg)
+        return "%s\n<small>%s</small>" % (self.song_description(song), msg)
 
     @staticmethod
     def song_icon(song):
@@ -1233,20 +1735,141 @@ class PithosWindow(Gtk.ApplicationWindow):
     def update_song_row(self, song = None):
         if song is None:
             song = self.current_song
-        if song:
-            self.songs_model[song.index][1] = self.song_text(song)
-            self.songs_model[song.index][2] = self.song_icon(song)
+        row = self.song_row(song) if song else None
+        if row is not None:
+            # Writing the row redraws it, skip that when nothing shown has changed.
+            markup = self.song_text(song)
+            if markup != song.row_markup:
+                song.row_markup = markup
+                row[1] = markup
+            icon = self.song_icon(song)
+            if icon != song.row_icon:
+                song.row_icon = icon
+                row[2] = icon
         return True
 
+    def song_row(self, song):
+        """Returns the songs_model row of song or None if it has been removed"""
+        if 0 <= song.index < len(self.songs_model):
+            row = self.songs_model[song.index]
+            if row[0] is song:
+                return row
+        return None
+
+    def album_art_size(self):
+        """The size in pixels to decode album art at, larger than the cell on HiDPI screens"""
+        return ALBUM_ART_SIZE * self.get_scale_factor()
+
+    def fetch_album_art(self, url, size, cancel_token=None):
+        """Returns the cover at url as (pixbuf, file url) with the pixbuf size pixels square, this blocks"""
+        # Songs from the same album share the pixbuf decoded for the first one.
+        pixbuf = self.pixbuf_cache.get(url, size)
+        path = self.art_cache.lookup(url) if pixbuf is not None else None
+        if path is None:
+            try:
+                path, image = self.art_cache.fetch(url, cancel_token)
+            except OSError as e:
+                # Timeouts included, the song just goes without a cover.
+                logging.warning('Failed to get album art: {}'.format(e))
+                return None, None
+            if pixbuf is None:
+                pixbuf = self.pixbuf_cache.decode(url, size, image)
+
+        file_url = album_art.file_url(path) if path else None
+        return pixbuf, file_url
+
+    def trim_history(self, *ignore):
+        """Keeps the songs before the current one within the history settings
+
+        Songs more than history-length back are compacted and lose their album
+        art until they're scrolled to. Past history-max-length the oldest rows
+        are removed and the rest renumbered.
+        """
+        if self.current_song_index is None:
+            return
+
+        max_length = self.settings['history-max-length']
+        excess = self.current_song_index - max_length
+        if excess > 0:
+            # Remove some extra so this doesn't happen for every song.
+            excess = min(self.current_song_index, excess + max_length // 10)
+            logging.info("Removing %i songs from the history" % excess)
+            for i in range(excess):
+                self.songs_model[0][0].index = -1
+                del self.songs_model[0]
+            for row in self.songs_model:
+                row[0].index -= excess
+            self.current_song_index -= excess
+
+        # Everything before the first compacted song we find already is.
+        index = self.current_song_index - self.settings['history-length'] - 1
+        while index >= 0:
+            row = self.songs_model[index]
+            song = row[0]
+            if song.compacted:
+                break
+            song.compact()
+            song.art_pixbuf = None
+            row[3] = None
+            index -= 1
+
+    def reload_visible_art(self, *ignore):
+        """Loads the album art of compacted songs scrolled into view"""
+        visible = self.songs_treeview.get_visible_range()
+        if not visible:
+            return
+
+        def callback(result, song):
+            self.art_reloading.discard(song)
+            row = self.song_row(song)
+            if row is not None and song.compacted:
+                song.art_pixbuf = result[0]
+                row[3] = result[0]
+
+        start, end = visible
+        for index in range(start.get_indices()[0], end.get_indices()[0] + 1):
+            song = self.songs_model[index][0]
+            if (song.compacted and song.art_pixbuf is None and song.artRadio
+                    and song not in self.art_reloading):
+                self.art_reloading.add(song)
+                self.worker_run(self.fetch_album_art, (song.artRadio, self.album_art_size()), callback, context=None,
+                                user_data=song, priority=PRIORITY_BACKGROUND,
+                                cancel_token=self.playlist_tasks.token, kind='album-art')
+
     def create_ui_loop(self):
-        if not self.ui_loop_timer_id:
-            self.ui_loop_timer_id = GLib.timeout_add_seconds(1, self.update_song_row)
+        self.ui_loop_wanted = True
+        self.sync_ui_loop()
 
     def destroy_ui_loop(self):
-        if self.ui_loop_timer_id:
+        self.ui_loop_wanted = False
+        self.sync_ui_loop()
+
+    def sync_ui_loop(self):
+        """Runs the once a second row update only while it can be seen"""
+        run = self.ui_loop_wanted and self.ui_mapped and not self.ui_iconified
+        if run and not self.ui_loop_timer_id:
+            # Catch up on whatever happened while we were hidden.
+            self.update_song_row()
+            self.ui_loop_timer_id = GLib.timeout_add_seconds(1, self.update_song_row)
+        elif not run and self.ui_loop_timer_id:
             GLib.source_remove(self.ui_loop_timer_id)
             self.ui_loop_timer_id = 0
 
+    def on_map_event(self, widget, event):
+        self.ui_mapped = True
+        self.sync_ui_loop()
+        return False
+
+    def on_unmap_event(self, widget, event):
+        self.ui_mapped = False
+        self.sync_ui_loop()
+        return False
+
+    def on_window_state_event(self, widget, event):
+        self.ui_iconified = bool(event.new_window_state & Gdk.WindowState.ICONIFIED)
+        self.sync_ui_loop()
+        return False
+
     def active_station_changed(self, listbox, row):
         self.station_changed(row.station)
 
@@ -1278,46 +1901,93 @@ class PithosWindow(Gtk.ApplicationWindow):
             self.start_song(self.selected_song().index)
         return playable
 
+    def feedback_queued(self, song):
+        self.update_song_row(song)
+        self.emit('metadata-changed', song)
+        self.schedule_feedback_flush()
+
+    def schedule_feedback_flush(self, delay=FEEDBACK_FLUSH_DELAY):
+        """Sends queued feedback in delay seconds, anything queued until then goes with it"""
+        self.cancel_feedback_flush()
+        self.feedback_flush_timer_id = GLib.timeout_add_seconds(delay, self.on_feedback_flush_timeout)
+
+    def cancel_feedback_flush(self):
+        if self.feedback_flush_timer_id:
+            GLib.source_remove(self.feedback_flush_timer_id)
+            self.feedback_flush_timer_id = 0
+
+    def on_feedback_flush_timeout(self):
+        self.feedback_flush_timer_id = 0
+        self.flush_feedback()
+        return False
+
+    def flush_feedback(self):
+        # A flush that was scheduled would only send the same entries again.
+        self.cancel_feedback_flush()
+        if not self.pandora.connected:
+            # It's flushed once we're connected again.
+            return False
+
+        def flush():
+            try:
+                return self.feedback.flush()
+            except PandoraNetError as e:
+                # An invalid auth token is left to worker_run which reconnects and retries.
+                logging.warning('Failed to send feedback: %s', e.message)
+                return None
+
+        def callback(result):
+            if result is None:
+                self.schedule_feedback_flush(self.feedback_retry_delay)
+                self.feedback_retry_delay = min(self.feedback_retry_delay * 2, FEEDBACK_MAX_RETRY_DELAY)
+            else:
+                remaining, rejected = result
+                for song, step, rating in rejected:
+                    # Show what Pandora has rather than what it refused.
+                    if self.feedback.revert(song, step, rating) and self.song_row(song) is not None:
+                        self.update_song_row(song)
+                        self.emit('metadata-changed', song)
+                self.feedback_retry_delay = FEEDBACK_FLUSH_DELAY
+                if remaining:
+                    # More was queued while we were sending.
+                    self.schedule_feedback_flush()
+
+        self.worker_run(flush, (), callback, context=None, priority=PRIORITY_BACKGROUND)
+        return False
+
     def love_song(self, *ignore, song=None):
         song = song or self.current_song
-        def callback(l):
-            self.update_song_row(song)
-            self.emit('metadata-changed', song)
-        self.worker_run(song.rate, (RATE_LOVE,), callback, "Loving song...")
-
+        self.feedback.rate(song, RATE_LOVE)
+        self.feedback_queued(song)
 
     def ban_song(self, *ignore, song=None):
         song = song or self.current_song
-        def callback(l):
-            self.update_song_row(song)
-            self.emit('metadata-changed', song)
-        self.worker_run(song.rate, (RATE_BAN,), callback, "Banning song...")
+        self.feedback.rate(song, RATE_BAN)
+        self.feedback_queued(song)
         if song is self.current_song:
             self.next_song()
 
     def unrate_song(self, *ignore, song=None):
         song = song or self.current_song
-        def callback(l):
-            self.update_song_row(song)
-            self.emit('metadata-changed', song)
-        self.worker_run(song.rate, (RATE_NONE,), callback, "Removing song rating...")
+        self.feedback.rate(song, RATE_NONE)
+        self.feedback_queued(song)
 
     def tired_song(self, *ignore, song=None):
         song = song or self.current_song
-        def callback(l):
-            self.update_song_row(song)
-            self.emit('metadata-changed', song)
-        self.worker_run(song.set_tired, (), callback, "Putting song on shelf...")
+        self.feedback.set_tired(song)
+        self.feedback_queued(song)
         if song is self.current_song:
             self.next_song()
 
     def bookmark_song(self, *ignore, song=None):
         song = song or self.current_song
-        self.worker_run(song.bookmark, (), None, "Bookmarking...")
+        self.feedback.bookmark(song)
+        self.schedule_feedback_flush()
 
     def bookmark_song_artist(self, *ignore, song=None):
         song = song or self.current_song
-        self.worker_run(song.bookmark_artist, (), None, "Bookmarking...")
+        self.feedback.bookmark_artist(song)
+        self.schedule_feedback_flush()
 
     def info_song(self, *ignore, song=None):
         song = song or self.current_song
@@ -1494,4 +2164,6 @@ class PithosWindow(Gtk.ApplicationWindow):
     def on_destroy(self, widget, data=None):
         """on_destroy - called when the PithosWindow is close. """
         self.stop()
+        self.prefetcher.release_all()
+        self.cancel_feedback_flush()
         self.quit()
@@ -17,7 +17,7 @@ import logging
 
 from gi.repository import Gtk, GObject
 
-from pithos.gobject_worker import GObjectWorker
+from pithos.gobject_worker import GObjectWorker, PRIORITY_BACKGROUND
 from pithos.plugin import PithosPlugin
 from pithos.util import open_browser
 
@@ -182,7 +182,8 @@ class LastfmPlugin(PithosPlugin):
         def success(*ignore):
             logging.debug('Updated Last.fm now playing. {} by {}'.format(song.title, song.artist))
 
-        self.worker.send(self.network.update_now_playing, (song.artist, song.title, song.album), success, err)
+        self.worker.send(self.network.update_now_playing, (song.artist, song.title, song.album), success, err,
+                         priority=PRIORITY_BACKGROUND)
 
     def _on_song_ended(self, window, song):
         def err(e):
@@ -204,7 +205,7 @@ class LastfmPlugin(PithosPlugin):
                 int(duration),
             )
 
-            self.worker.send(self.network.scrobble, args, success, err)
+            self.worker.send(self.network.scrobble, args, success, err, priority=PRIORITY_BACKGROUND)
 
 
 class LastFmAuth(Gtk.Dialog):
@@ -209,6 +209,16 @@ class PithosMprisService(DBusServiceObject):
                 'station-added',
                 self._add_playlist_handler,
             ),
+
+            window.connect(
+                'station-removed',
+                self._remove_playlist_handler,
+            ),
+
+            window.connect(
+                'station-renamed',
+                self._rename_playlist_handler,
+            ),
         ]
 
         if window.stations_dlg:
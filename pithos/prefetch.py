@@ -0,0 +1,367 @@
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: nil; -*-
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Audio prefetching
+
+:py:class:`Prefetcher` downloads songs to disk as fast as the network allows
+and serves them to GStreamer over HTTP on 127.0.0.1 while the download is
+still going. Playback only stalls when the download has really fallen
+behind, not on every hiccup. Files are removed as soon as a song is
+released, nothing is kept between songs or sessions.
+"""
+
+import hashlib
+import http.server
+import logging
+import os
+import socketserver
+import threading
+import urllib.request
+
+CHUNK_SIZE = 64 * 1024
+# A 192kbit/s song of 10 minutes is about 14 MiB
+MAX_FILE_BYTES = 64 * 1024 * 1024
+# The current song, the next one and one being replaced
+MAX_DOWNLOADS = 3
+# Times a broken download is resumed
+MAX_RETRIES = 3
+TIMEOUT = 30
+
+
+class _Download:
+    def __init__(self, key, url, path):
+        self.key = key
+        self.url = url
+        self.path = path
+        self.id = os.path.basename(path)
+        self.cond = threading.Condition()
+        self.written = 0
+        self.length = None
+        self.content_type = 'application/octet-stream'
+        self.done = False
+        self.failed = False
+        self.cancelled = False
+
+    def run(self):
+        retries = 0
+        with open(self.path, 'wb') as f:
+            while not self.cancelled:
+                request = urllib.request.Request(self.url)
+                if self.written:
+                    request.add_header('Range', 'bytes={}-'.format(self.written))
+                try:
+                    with urllib.request.urlopen(request, timeout=TIMEOUT) as response:
+                        if self.written and response.status != 206:
+                            raise OSError('Server ignored the range request')
+                        self._started(response)
+                        while not self.cancelled:
+                            chunk = response.read(CHUNK_SIZE)
+                            if not chunk:
+                                break
+                            if self.written + len(chunk) > MAX_FILE_BYTES:
+                                raise OSError('Larger than {} bytes'.format(MAX_FILE_BYTES))
+                            f.write(chunk)
+                            f.flush()
+                            with self.cond:
+                                self.written += len(chunk)
+                                self.cond.notify_all()
+                    break
+                except OSError as e:
+                    retries += 1
+                    if retries > MAX_RETRIES or self.cancelled:
+                        logging.warning('Prefetch of {} failed: {}'.format(self.key, e))
+                        with self.cond:
+                            self.failed = True
+                            self.cond.notify_all()
+                        return
+                    logging.info('Resuming prefetch of {} after: {}'.format(self.key, e))
+        with self.cond:
+            self.done = True
+            self.cond.notify_all()
+
+    def _started(self, response):
+        with self.cond:
+            if self.length is None:
+                length = response.headers.get('Content-Length')
+                if length is not None:
+                    self.length = self.written + int(length)
+                self.content_type = response.headers.get('Content-Type', self.content_type)
+            self.cond.notify_all()
+
+    def wait_for(self, offset):
+        """Blocks until there's data past offset, returns False if there will never be"""
+        with self.cond:
+            while self.written <= offset:
+                if self.done or self.failed or self.cancelled:
+                    return False
+                self.cond.wait(TIMEOUT)
+            return True
+
+    def wait_finished(self):
+        with self.cond:
+            while not (self.done or self.failed or self.cancelled):
+                self.cond.wait()
+
+    def cancel(self):
+        with self.cond:
+            self.cancelled = True
+            self.cond.notify_all()
+
+
+def _parse_range(header, length):
+    """Returns the (first, last) byte a Range header asks for, None to send everything
+
+    Ranges are only honoured once the length is known, and only single ones.
+    Malformed ones are ignored.
+
+    :raises ValueError: If the range can't be satisfied, the reply is 416
+    """
+    if length is None or not header.startswith('bytes=') or ',' in header:
+        return None
+    first, sep, last = header[len('bytes='):].strip().partition('-')
+    well_formed = sep and (first or last) and all(not part or part.isdigit() for part in (first, last))
+    if not well_formed:
+        return None
+    if not first:
+        # The last bytes of the file
+        suffix = int(last)
+        if not suffix:
+            raise ValueError('Empty suffix range')
+        return max(length - suffix, 0), length - 1
+    first = int(first)
+    if last and int(last) < first:
+        return None
+    if first >= length:
+        raise ValueError('Range starts past the end')
+    last = int(last) if last else length - 1
+    return first, min(last, length - 1)
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        logging.debug('Prefetch server: ' + format % args)
+
+    def do_GET(self):
+        download = self.server.prefetcher.get_download(self.path.lstrip('/'))
+        if download is None:
+            self.send_error(404)
+            return
+
+        # Headers need the length, wait for the response to start.
+        download.wait_for(0)
+        with download.cond:
+            length = download.length
+            if download.failed and not download.written:
+                self.send_error(502)
+                return
+
+        try:
+            byte_range = _parse_range(self.headers.get('Range', ''), length)
+        except ValueError:
+            self.send_response(416)
+            self.send_header('Content-Range', 'bytes */{}'.format(length))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        if byte_range is None:
+            # No range, or one that can't be answered before the length is known.
+            start, end = 0, None if length is None else length - 1
+            self.send_response(200)
+        else:
+            start, end = byte_range
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, length))
+        if end is not None:
+            self.send_header('Content-Length', str(end - start + 1))
+            self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Type', download.content_type)
+        self.end_headers()
+
+        offset = start
+        try:
+            with open(download.path, 'rb') as f:
+                f.seek(offset)
+                while (end is None or offset <= end) and download.wait_for(offset):
+                    size = CHUNK_SIZE if end is None else min(CHUNK_SIZE, end - offset + 1)
+                    chunk = f.read(size)
+                    if not chunk:
+                        continue
+                    self.wfile.write(chunk)
+                    offset += len(chunk)
+                if end is None or offset <= end:
+                    # Whatever was written after the last wait
+                    chunk = f.read() if end is None else f.read(end - offset + 1)
+                    if chunk:
+                        self.wfile.write(chunk)
+                        offset += len(chunk)
+        except (OSError, ConnectionError) as e:
+            # GStreamer closed the connection, e.g. the song was skipped.
+            logging.debug('Prefetch server: {}'.format(e))
+            return
+
+        if (end is None or offset <= end) and download.failed and not download.cancelled:
+            # The headers promised the whole range, finish it from the original url.
+            logging.info('Streaming the rest of {} without prefetch'.format(download.key))
+            try:
+                self._send_from_url(download.url, offset, end)
+            except (OSError, ConnectionError) as e:
+                logging.warning('Failed to stream the rest of {}: {}'.format(download.key, e))
+
+    def _send_from_url(self, url, offset, end):
+        """Sends bytes offset to end of url, to the end of the file if end is None"""
+        request = urllib.request.Request(url)
+        request.add_header('Range', 'bytes={}-{}'.format(offset, '' if end is None else end))
+        with urllib.request.urlopen(request, timeout=TIMEOUT) as response:
+            if response.status != 206:
+                # The range was ignored, skip what was already sent.
+                skip = offset
+                while skip:
+                    chunk = response.read(min(CHUNK_SIZE, skip))
+                    if not chunk:
+                        raise OSError('Response ended before byte {}'.format(offset))
+                    skip -= len(chunk)
+            while end is None or offset <= end:
+                chunk = response.read(CHUNK_SIZE if end is None else min(CHUNK_SIZE, end - offset + 1))
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                offset += len(chunk)
+
+
+class _Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class Prefetcher:
+    """Downloads songs ahead of playback and serves them locally
+
+    :param directory: Where the partial files are kept, anything in it is removed
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+        # key: _Download, oldest first
+        self._downloads = {}
+        self._server = None
+        self._clear_directory()
+
+    def _clear_directory(self):
+        # Files left by a crash
+        try:
+            for entry in os.scandir(self.directory):
+                if entry.is_file():
+                    os.remove(entry.path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logging.warning('Failed to clear the prefetch directory: {}'.format(e))
+
+    def _start_server(self):
+        # Called with the lock held
+        if self._server is None:
+            self._server = _Server(('127.0.0.1', 0), _Handler)
+            self._server.prefetcher = self
+            thread = threading.Thread(target=self._server.serve_forever, name='pithos-prefetch-server')
+            thread.daemon = True
+            thread.start()
+        return self._server
+
+    @property
+    def base_url(self):
+        """The url prefix of local streams, None before the first one"""
+        with self._lock:
+            if self._server is None:
+                return None
+            return 'http://127.0.0.1:{}/'.format(self._server.server_address[1])
+
+    def is_local(self, uri):
+        base_url = self.base_url
+        return base_url is not None and uri.startswith(base_url)
+
+    def get_download(self, download_id):
+        with self._lock:
+            for download in self._downloads.values():
+                if download.id == download_id:
+                    return download
+        return None
+
+    def prefetch(self, key, url, after_key=None):
+        """Starts downloading url unless it already is
+
+        :param key:       Identifies the song, e.g. its trackToken, to :py:meth:`release` it later
+        :param after_key: Don't start until the download of this key has finished,
+                          so the song playing gets all the bandwidth
+        :returns: The local url to play it from, or url itself if it can't be prefetched
+        """
+        try:
+            with self._lock:
+                server = self._start_server()
+                download = self._downloads.get(key)
+                if download is None:
+                    while len(self._downloads) >= MAX_DOWNLOADS:
+                        self._release(next(iter(self._downloads)))
+                    os.makedirs(self.directory, exist_ok=True)
+                    name = hashlib.sha1(key.encode('utf-8')).hexdigest()
+                    download = _Download(key, url, os.path.join(self.directory, name))
+                    self._downloads[key] = download
+                    after = self._downloads.get(after_key)
+                    thread = threading.Thread(target=self._run, args=(download, after), name='pithos-prefetch')
+                    thread.daemon = True
+                    thread.start()
+                return 'http://127.0.0.1:{}/{}'.format(server.server_address[1], download.id)
+        except OSError as e:
+            logging.warning('Streaming without prefetch: {}'.format(e))
+            return url
+
+    def _run(self, download, after):
+        try:
+            if after is not None:
+                after.wait_finished()
+            if not download.cancelled:
+                download.run()
+        except OSError as e:
+            logging.warning('Prefetch of {} failed: {}'.format(download.key, e))
+            with download.cond:
+                download.failed = True
+                download.cond.notify_all()
+        finally:
+            if download.cancelled:
+                self._remove_file(download)
+
+    @staticmethod
+    def _remove_file(download):
+        try:
+            os.remove(download.path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logging.warning('Failed to remove prefetched audio: {}'.format(e))
+
+    def _release(self, key):
+        # Called with the lock held
+        download = self._downloads.pop(key, None)
+        if download is not None:
+            download.cancel()
+            # Readers that have it open keep reading, the data is gone once they close it.
+            self._remove_file(download)
+
+    def release(self, key):
+        """Stops the download of key and removes its file"""
+        with self._lock:
+            self._release(key)
+
+    def release_all(self):
+        with self._lock:
+            for key in list(self._downloads):
+                self._release(key)
@@ -13,7 +13,11 @@
 # with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import contextlib
 import logging
+import os
+import tempfile
+import time
 from urllib.parse import splittype, splituser, splitpasswd
 
 import gi
@@ -33,6 +37,13 @@ class _SecretService:
         {'email': Secret.SchemaAttributeType.STRING},
     )
 
+    # Auth tokens from Pandora.export_session(), so a restart can skip logging in
+    _session_schema = Secret.Schema.new(
+        'io.github.Pithos.Session',
+        Secret.SchemaFlags.NONE,
+        {'email': Secret.SchemaAttributeType.STRING},
+    )
+
     def __init__(self):
         self._current_collection = Secret.COLLECTION_DEFAULT
 
@@ -175,6 +186,41 @@ class _SecretService:
                 None,
             )
 
+    def get_session(self, email, callback):
+        def on_session_lookup_finish(source, result, data):
+            try:
+                session = Secret.password_lookup_finish(result)
+            except GLib.Error as e:
+                session = None
+                logging.error('Failed to lookup session, Error: {}'.format(e))
+            callback(session)
+
+        Secret.password_lookup(
+            self._session_schema,
+            {'email': email},
+            None,
+            on_session_lookup_finish,
+            None,
+        )
+
+    def set_session(self, email, session):
+        def on_session_store_finish(source, result, data):
+            try:
+                Secret.password_store_finish(result)
+            except GLib.Error as e:
+                logging.error('Failed to store session, Error: {}'.format(e))
+
+        Secret.password_store(
+            self._session_schema,
+            {'email': email},
+            self._current_collection,
+            'Pandora Session',
+            session,
+            None,
+            on_session_store_finish,
+            None,
+        )
+
 
 SecretService = _SecretService()
 
@@ -204,6 +250,32 @@ def parse_proxy(proxy):
     return scheme, user, password, hostport
 
 
+@contextlib.contextmanager
+def atomic_write(path, mode='wb', prefix='.tmp-', **kwargs):
+    """Opens a temporary file that replaces path once the block finishes
+
+    The directory is created if needed. If the block raises, the temporary
+    file is removed and path is left as it was.
+
+    :param mode:   Mode the file is opened in, 'w' or 'wb'
+    :param prefix: Prefix of the temporary file name
+    :param kwargs: Passed on to open, such as encoding
+    """
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    f = tempfile.NamedTemporaryFile(mode, dir=directory, prefix=prefix, delete=False, **kwargs)
+    try:
+        with f:
+            yield f
+        os.replace(f.name, path)
+    except BaseException:
+        try:
+            os.unlink(f.name)
+        except OSError:
+            pass
+        raise
+
+
 def open_browser(url, parent=None, timestamp=0):
     logging.info("Opening URL {}".format(url))
     if not timestamp:
@@ -223,3 +295,30 @@ if hasattr(Gtk.Menu, 'popup_at_pointer'):
     popup_at_pointer = Gtk.Menu.popup_at_pointer
 else:
     popup_at_pointer = lambda menu, event: menu.popup(None, None, None, None, event.button, event.time)
+
+
+class StartupTimeline:
+    """Logs how long after startup each step finished
+
+    Steps are logged as they happen and the whole timeline once
+    :py:meth:`finish` is called, after which marks are ignored.
+    """
+    def __init__(self):
+        self.start = time.monotonic()
+        self.marks = []
+        self.finished = False
+
+    def mark(self, step):
+        if self.finished:
+            return
+        elapsed = time.monotonic() - self.start
+        self.marks.append((step, elapsed))
+        logging.debug('Startup: {} after {:.0f}ms'.format(step, elapsed * 1000))
+
+    def finish(self, step):
+        if self.finished:
+            return
+        self.mark(step)
+        self.finished = True
+        logging.info('Startup timeline: {}'.format(
+            ', '.join('{} {:.0f}ms'.format(name, elapsed * 1000) for name, elapsed in self.marks)))